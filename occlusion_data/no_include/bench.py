@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+import numpy as np
+
+import cache
+import store
+import readers
+import design
+import model
+import network
+import modelgrid
+import sim
+
+## Benchmark suite
+# Generates synthetic campaigns of 65k-row 'a+bi' CSVs (MATLAB export layout, 0.336 Hz grid) and times the stages
+# of sim.py on them: file readers, read_measurements (cold and cached), model setup, transfer functions, statistics,
+# ear muff simulation and the four figures. Every stage runs once to warm up (imports, memoized model parts), is
+# then timed `repeat` times (best and mean are reported) and run once more under tracemalloc for its peak memory
+# (allocations of this process, NumPy included; parse workers of other processes are not counted).
+# Results are written as JSON and can be compared against a previous run with --compare.
+#
+#   python occlusion_data/no_include/bench.py --files 8 64 --output bench.json
+#   python occlusion_data/no_include/bench.py --files 8 64 --compare bench.json --threshold 1.25
+
+fs = 44100
+n_templates = 8
+
+def synthetic_impedance(frequencies, rng):
+    '''
+    Smooth ear canal entrance like impedance (resistance, mass and compliance with a random spread)
+    '''
+    omega = 2*np.pi*np.maximum(frequencies, 1)
+    R = 400 * rng.uniform(0.8, 1.2)
+    M = 0.05 * rng.uniform(0.5, 2)
+    C = 1e-6 * rng.uniform(0.5, 2)
+    return R + 1j*(omega*M - 1/(omega*C))
+
+def write_csv(file_path, frequencies, data):
+    with open(file_path, 'w') as f:
+        f.write(''.join( f'{freq:.15g}+0i,{value.real:.15g}{value.imag:+.15g}i\n' for freq, value in zip(frequencies, data) ))
+
+def make_dataset(root, n_files, n_rows = 65536, n_campaigns = 2, seed = 0):
+    '''
+    Writes a synthetic data set to root: reference/, measurements/<campaign>/ with n_files CSVs in total and
+    occlusion_data/ with one mean/std collection. Only n_templates distinct files are generated, the rest are copies.
+
+    Returns:
+    - dict: Folders of the data set
+    '''
+    rng = np.random.default_rng(seed)
+    frequencies = np.arange(1, n_rows + 1) * fs / (2*n_rows)
+
+    folders = {name: os.path.join(root, name) for name in ('reference', 'measurements', 'occlusion_data')}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+
+    write_csv(os.path.join(folders['reference'], 'Synthetic_reference_Z.csv'), frequencies, synthetic_impedance(frequencies, rng) / 5)
+
+    templates = []
+    for i in range(min(n_templates, n_files)):
+        template = os.path.join(root, f'template_{i}.csv')
+        write_csv(template, frequencies, synthetic_impedance(frequencies, rng))
+        templates.append(template)
+
+    for i in range(n_files):
+        campaign = os.path.join(folders['measurements'], f'Campaign_{i % n_campaigns}')
+        if not os.path.isdir(campaign):
+            os.makedirs(campaign)
+            with open(os.path.join(campaign, 'config.json'), 'w') as f:
+                json.dump({'color': f'C{i % n_campaigns}', 'linestyle': 'solid'}, f)
+        shutil.copyfile(templates[i % len(templates)], os.path.join(campaign, f'Insertion_{i:05d}_Z.csv'))
+
+    occl = os.path.join(folders['occlusion_data'], 'Synthetic occlusion')
+    os.makedirs(occl, exist_ok=True)
+    with open(os.path.join(occl, 'config.json'), 'w') as f:
+        json.dump({'color': '#000000', 'linestyle': 'dashed'}, f)
+    occl_freqs = np.geomspace(50, 2000, 64)
+    write_csv(os.path.join(occl, 'Synthetic_mean.csv'), occl_freqs, 20 - 10*np.log10(occl_freqs / 50) + 0j)
+    write_csv(os.path.join(occl, 'Synthetic_std.csv'), occl_freqs, 3 + 0*occl_freqs + 0j)
+
+    return folders
+
+def run_stage(name, func, repeat = 3, trace_memory = True):
+    '''
+    Times func repeat times after one warm-up run and measures its peak memory in one extra run
+
+    Returns:
+    - dict: 'stage', 'seconds' (best), 'mean_seconds', 'peak_bytes' (None if not traced)
+    '''
+    func()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {'stage': name, 'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_bytes': peak}
+
+def air_absorber(resis, poros, tortu, visc_l, therm_l, frequencies = None):
+    '''
+    Empty cup (air instead of the absorber), keeps the ear muff sweep independent of pyabsorp
+    '''
+    frequencies = sim.frequencies if frequencies is None else frequencies
+    return np.full(len(frequencies), sim.Z0, dtype=np.complex128), (2*np.pi*frequencies / sim.c).astype(np.complex128)
+
+def bench_files(root, n_files, n_rows, repeat, trace_memory, workers, figures = True):
+    '''
+    Generates a data set with n_files measurements and benchmarks all stages on it
+
+    Returns:
+    - list: One result dict per stage (see run_stage) with 'files' and 'rows' added
+    '''
+    folders = make_dataset(root, n_files, n_rows)
+    results = []
+
+    def stage(name, func, **kwargs):
+        try:
+            result = run_stage(name, func, kwargs.get('repeat', repeat), trace_memory)
+        except ImportError as e:
+            print(f'MESSAGE: Skipping {name} ({e})')
+            return
+        result.update(files = n_files, rows = n_rows)
+        results.append(result)
+        print(f"{n_files:>6} files  {name:<32} {result['seconds']*1e3:10.1f} ms" + (f"  {result['peak_bytes'] / 2**20:8.1f} MiB" if result['peak_bytes'] is not None else ''))
+
+    sim.measurements_folder = folders['measurements']
+    sim.ref_folder = folders['reference']
+    sim.occl_plots_folder = folders['occlusion_data']
+    sim.reference = None
+    sim.interactive = False
+    sim.workers = workers
+    sim.freq_range = [100, 1500]
+    store.store_dir = os.path.join(root, 'store')
+    cache.cache_dir = os.path.join(root, 'cache')
+
+    sample = os.path.join(folders['measurements'], 'Campaign_0', 'Insertion_00000_Z.csv')
+
+    # File readers (single file, no cache)
+    stage('read_frequency_arrays', lambda: readers.read_frequency_arrays(sample))
+    stage('read_frequency_range', lambda: readers.read_frequency_range(sample, sim.freq_range))
+    stage('read_frequency_csv', lambda: readers.read_frequency_csv(sample))
+
+    # Ingestion
+    cache.mode = 'bypass'
+    sim.read_reference()
+
+    def read_measurements():
+        sim.measurements = {}
+        sim.read_measurements()
+
+    stage('read_measurements', read_measurements)
+    cache.mode = 'use'
+    stage('read_measurements_cached', read_measurements)
+    stage('read_occlusion_data', sim.read_occlusion_data)
+
+    # Model
+    stage('compile_outer_ear', lambda: network.compile_network(model.outer_ear_description()))
+    stage('build_model', sim.build_model)
+    stage('simulate_transfer_functions', sim.simulate_transfer_functions)
+    stage('compute_statistics', sim.compute_statistics)
+    stage('ear_muff_simulation', lambda: sim.ear_muff_simulation(0.1, 0.05, 0.0027, 3.5e-3, sim.k, sim.k, sim.Z0, sim.Z0, sim.frequencies))
+    sweep = design.design_grid(l_cup = np.linspace(0.02, 0.2, 32), l_abs = np.linspace(0.02, 0.2, 32), S_cup = 0.0027, S_abs = 3.5e-3,
+                               resis = sim.resis, poros = sim.poros, tortu = sim.tortu, visc_l = sim.visc_l, therm_l = sim.therm_l)
+    stage('ear_muff_sweep_1024', lambda: design.ear_muff_sweep(sweep, sim.frequencies, sim.ec_terms, sim.pinna_offset, air_absorber, sim.c, sim.rho0))
+    grid = modelgrid.log_grid(sim.frequencies[0], sim.frequencies[-1], modelgrid.points_per_decade)
+    stage('ear_muff_sweep_1024_log', lambda: modelgrid.to_measurement(grid, design.ear_muff_sweep(sweep, grid, *sim.model_on(grid), air_absorber, sim.c, sim.rho0)[1], sim.frequencies))
+
+    boxes = True
+    try:
+        sim.simulate_boxes()
+        stage('simulate_boxes', sim.simulate_boxes)
+    except ImportError as e:
+        print(f'MESSAGE: Skipping simulate_boxes ({e}), figures are drawn without boxes')
+        sim.T_boxes = []
+        boxes = False
+
+    # Figures, one at a time, rendered headless and saved
+    if figures:
+        with open('figures.json', 'r') as f:
+            config = json.load(f)
+        output_dir = os.path.join(root, 'figures')
+        for num in range(1, 5):
+            only = { key: dict(value, show = key == f'fig{num}') for key, value in config.items() }
+            stage(f'fig{num}' + ('' if sim.plot_backend == 'pyfar' else f'_{sim.plot_backend}') + ('' if boxes else '_no_boxes'), lambda: sim.plot_figures(only, show = False, output_dir = output_dir), repeat = 1)
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, threshold = 1.25, min_seconds = 0.005):
+    '''
+    Compares the best times of two runs stage by stage
+
+    Returns:
+    - list: (stage, files, baseline seconds, seconds, ratio) of all stages slower than threshold x baseline
+    '''
+    base = { (entry['stage'], entry['files']): entry for entry in baseline['results'] }
+    regressions = []
+    print(f"{'stage':<32} {'files':>6} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for entry in results['results']:
+        reference = base.get((entry['stage'], entry['files']))
+        if reference is None:
+            continue
+        ratio = entry['seconds'] / max(reference['seconds'], 1e-12)
+        flag = ''
+        if ratio > threshold and entry['seconds'] > min_seconds:
+            regressions.append((entry['stage'], entry['files'], reference['seconds'], entry['seconds'], ratio))
+            flag = '  REGRESSION'
+        print(f"{entry['stage']:<32} {entry['files']:>6} {reference['seconds']*1e3:8.1f}ms {entry['seconds']*1e3:8.1f}ms {ratio:7.2f}{flag}")
+    return regressions
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmarks the stages of sim.py on synthetic measurement data.')
+    parser.add_argument('--files', nargs='+', type=int, default=[8, 64], help='Numbers of measurement files to benchmark (default: %(default)s)')
+    parser.add_argument('--rows', type=int, default=65536, help='Rows per CSV file (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None, help='Parallel file readers (default: one per core)')
+    parser.add_argument('--no-memory', action='store_true', help='Skips the tracemalloc run of every stage')
+    parser.add_argument('--no-figures', action='store_true', help='Skips the figure stages')
+    parser.add_argument('--plot-backend', choices=['pyfar', 'fast'], default=sim.plot_backend, help='Backend of the figure stages (default: %(default)s)')
+    parser.add_argument('--decimate', type=int, default=None, metavar='POINTS_PER_DECADE', help='Decimation of the fast backend')
+    parser.add_argument('--data', help='Keeps the synthetic data in this folder instead of a temporary one')
+    parser.add_argument('--output', default='bench.json', help='Result file (default: %(default)s)')
+    parser.add_argument('--compare', help='Previous result file to check against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Maximum allowed slowdown factor for --compare (default: %(default)s)')
+    parser.add_argument('--min-seconds', type=float, default=0.005, help='Stages faster than this are not flagged (default: %(default)s)')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    sim.plot_backend = args.plot_backend
+    sim.plot_decimation = args.decimate
+
+    results = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'rows': args.rows,
+            'repeat': args.repeat,
+            'workers': args.workers,
+            'plot_backend': args.plot_backend,
+            'decimate': args.decimate,
+        },
+        'results': [],
+    }
+
+    for n_files in args.files:
+        root = os.path.join(args.data, f'files_{n_files}') if args.data else tempfile.mkdtemp(prefix='occlusion_bench_')
+        try:
+            results['results'] += bench_files(root, n_files, args.rows, args.repeat, not args.no_memory, args.workers, not args.no_figures)
+        finally:
+            if not args.data:
+                shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved: {args.output}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print(f'ERROR: {len(regressions)} stage(s) slower than {args.threshold}x baseline')
+            return 1
+        print(f'MESSAGE: No stage slower than {args.threshold}x baseline')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+## Cache settings
+# mode: 'use' loads and stores entries, 'rebuild' ignores existing entries but stores fresh ones, 'bypass' disables the cache
+cache_dir = './.occlusion_cache'
+max_bytes = 512 * 2**20
+use_hash = False
+mode = 'use'
+
+# Part of every key, bump it when the parser or the cached format changes so older entries are not served
+format_version = 2
+
+# Running size in bytes per cache_dir, scanned by the first evict() and kept up to date by store()
+size_bytes = {}
+
+stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+def grid_digest(frequencies):
+    '''
+    Returns a short digest of a frequency grid, 'none' if no grid is given
+    '''
+    if frequencies is None:
+        return 'none'
+    return hashlib.sha1(np.ascontiguousarray(frequencies, dtype=np.float64).tobytes()).hexdigest()
+
+def file_digest(file_path):
+    '''
+    Returns the SHA-1 of the file content
+    '''
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def cache_key(file_path, freq_range, target = None, interp = None):
+    '''
+    Builds the cache key of a parsed file from its path, size, mtime and (optionally) content hash,
+    together with the frequency range, the target grid and the mode it was cropped and interpolated with.
+    '''
+    st = os.stat(file_path)
+    ident = {
+        'path': os.path.abspath(file_path),
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'hash': file_digest(file_path) if use_hash else None,
+        'freq_range': [float(f) for f in freq_range],
+        'grid': grid_digest(target),
+        'interp': interp if target is not None else None,
+        'version': format_version,
+    }
+    return hashlib.sha1(json.dumps(ident, sort_keys=True).encode()).hexdigest()
+
+def load(key):
+    '''
+    Returns the cached (frequencies, data) arrays for key or None on a miss
+    '''
+    if mode != 'use':
+        return None
+
+    entry = os.path.join(cache_dir, f'{key}.npz')
+    try:
+        with np.load(entry) as npz:
+            frequencies, data = npz['frequencies'], npz['data']
+    except (OSError, KeyError, ValueError):
+        stats['misses'] += 1
+        return None
+
+    # Mark entry as recently used for eviction
+    os.utime(entry)
+    stats['hits'] += 1
+    return frequencies, data
+
+def store(key, frequencies, data):
+    '''
+    Writes (frequencies, data) to the cache and evicts old entries if the size limit is exceeded. The directory is
+    only listed when the running size exceeds max_bytes (or has not been scanned yet).
+    '''
+    if mode == 'bypass':
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, f'{key}.npz')
+    tmp = os.path.join(cache_dir, f'{key}.tmp.npz')
+    np.savez(tmp, frequencies=frequencies, data=data)
+    os.replace(tmp, entry)
+    stats['stores'] += 1
+
+    if cache_dir in size_bytes:
+        size_bytes[cache_dir] += os.path.getsize(entry)
+    if size_bytes.get(cache_dir, max_bytes + 1) > max_bytes:
+        evict()
+
+def evict():
+    '''
+    Removes least recently used entries until the cache is smaller than max_bytes
+    '''
+    if not os.path.isdir(cache_dir):
+        size_bytes[cache_dir] = 0
+        return
+
+    entries = []
+    for file in os.listdir(cache_dir):
+        if file.endswith('.npz'):
+            st = os.stat(os.path.join(cache_dir, file))
+            entries.append((st.st_mtime, st.st_size, file))
+
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, file) in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(cache_dir, file))
+        total -= size
+        stats['evictions'] += 1
+    size_bytes[cache_dir] = total
+
+def clear():
+    '''
+    Removes all cache entries
+    '''
+    size_bytes[cache_dir] = 0
+    if not os.path.isdir(cache_dir):
+        return
+    for file in os.listdir(cache_dir):
+        if file.endswith('.npz'):
+            os.remove(os.path.join(cache_dir, file))
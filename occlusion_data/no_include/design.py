@@ -0,0 +1,201 @@
+import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import model
+import modelgrid
+
+## Ear muff design sweeps
+# A design is one row of a parameter table: cup (extension) length and area, absorber length and area,
+# and the Johnson-Champoux-Allard parameters of the absorber.
+geometry_keys = ('l_cup', 'l_abs', 'S_cup', 'S_abs')
+absorber_keys = ('resis', 'poros', 'tortu', 'visc_l', 'therm_l')
+
+def design_table(**columns):
+    '''
+    Builds a parameter table from explicit columns. Scalars are repeated for every design.
+
+    Returns:
+    - dict: parameter name -> np.ndarray with one entry per design
+    '''
+    n_designs = max(np.size(value) for value in columns.values())
+    return { key: np.broadcast_to(np.asarray(value, dtype=np.float64).reshape(-1), (n_designs,)).copy() for key, value in columns.items() }
+
+def design_grid(**axes):
+    '''
+    Builds a parameter table from the cartesian product of parameter vectors
+
+    Returns:
+    - dict: parameter name -> np.ndarray with one entry per design
+    '''
+    keys = list(axes)
+    rows = list(itertools.product(*( np.atleast_1d(axes[key]) for key in keys )))
+    return { key: np.array([ row[i] for row in rows ], dtype=np.float64) for i, key in enumerate(keys) }
+
+def lossy_wavenumber(k, frequencies, S, c = 343):
+    '''
+    Wave number in the cup including the empirical wall loss term used for the box simulations
+    '''
+    return k - 1j*6*10**(-2)*np.sqrt(frequencies / (c*(S/np.pi)))
+
+def ear_muff_sweep(designs, frequencies, terms, offset, absorber, c = 343, rho0 = 1.2, l_pin = 0.01, S_pin = 0.02**2, chunk = 256):
+    '''
+    Evaluates the ear muff model (pinna line -> cup line -> absorber line -> rigid wall) for a whole
+    parameter table in vectorized chunks. Equivalent to calling ear_muff_simulation for every row.
+
+    Parameters:
+    - designs (dict): Parameter table, see design_table and design_grid; needs geometry_keys and absorber_keys
+    - frequencies (np.ndarray): Frequency vector in Hz
+    - terms (network.Prepared): Prepared ear canal network, see sim.model_on
+    - offset (float or np.ndarray): Pinna offset applied to the EC input impedance
+    - absorber (callable): absorber(resis, poros, tortu, visc_l, therm_l, frequencies) -> (Z_eq, k_eq) over frequencies
+    - chunk (int): Number of designs evaluated at once, bounds memory
+
+    Returns:
+    - (np.ndarray, np.ndarray, dict): Load impedances and transfer functions, both (n_designs, n_freqs), and the parameter table
+    '''
+    n_designs = len(designs['l_cup'])
+    frequencies = np.asarray(frequencies)
+    k = 2*np.pi*frequencies / c
+    Z0 = rho0*c
+
+    # Absorber model is only evaluated once per distinct parameter set
+    params = np.stack([ designs[key] for key in absorber_keys ], axis=1)
+    unique_params, absorber_index = np.unique(params, axis=0, return_inverse=True)
+    absorber_index = absorber_index.reshape(-1)
+    Z_eqs = np.empty((len(unique_params), len(frequencies)), dtype=np.complex128)
+    k_eqs = np.empty((len(unique_params), len(frequencies)), dtype=np.complex128)
+    for i, p in enumerate(unique_params):
+        Z_eqs[i], k_eqs[i] = absorber(*p, frequencies)
+
+    # Pinna line is the same for all designs
+    pin = model.transmission_line(k, l_pin, S_pin, Z0)
+
+    Z_load = np.empty((n_designs, len(frequencies)), dtype=np.complex128)
+    T = np.empty((n_designs, len(frequencies)), dtype=np.complex128)
+    for start in range(0, n_designs, chunk):
+        rows = slice(start, min(start + chunk, n_designs))
+        l_cup, l_abs, S_cup, S_abs = ( designs[key][rows, None] for key in geometry_keys )
+        idx = absorber_index[rows]
+
+        Z_abs = model.input_impedance(*model.line_abcd(k_eqs[idx], l_abs, S_abs, Z_eqs[idx]), np.inf)
+        Z_cup = model.input_impedance(*model.line_abcd(lossy_wavenumber(k, frequencies, S_cup, c), l_cup, S_cup, Z0), Z_abs)
+        Z_load[rows] = model.input_impedance(*pin, Z_cup)
+        T[rows] = model.transfer_functions(Z_load[rows], terms, offset)
+
+    return Z_load, T, designs
+
+## Fitting
+def occlusion_objective(T, T_ref, target = None):
+    '''
+    Objective for a stack of transfer functions (n_designs, n_freqs)
+    - Without target: mean occlusion effect 20*log10|T / T_ref| in dB (to be minimized)
+    - With target: mean squared difference in dB to the target occlusion curve (magnitude, same grid)
+
+    Returns:
+    - np.ndarray: One value per design
+    '''
+    occlusion_db = 20*np.log10(np.abs(T / T_ref))
+    if target is None:
+        return occlusion_db.mean(axis=-1)
+    return ((occlusion_db - 20*np.log10(np.abs(target)))**2).mean(axis=-1)
+
+def descend(u0, keys, bounds, fixed, frequencies, terms, offset, absorber, T_ref, target, iterations, step, fd_step, tol, grid, sweep_kwargs):
+    '''
+    Projected Adam descent of several starts at once. u holds the free parameters normalized to [0, 1].
+    Each iteration evaluates every start and its forward difference perturbations in one sweep.
+    '''
+    n_starts, n_params = u0.shape
+    lo = np.array([ bounds[key][0] for key in keys ], dtype=np.float64)
+    span = np.array([ bounds[key][1] - bounds[key][0] for key in keys ], dtype=np.float64)
+
+    def evaluate(u):
+        designs = design_table(**{ key: lo[i] + u[:, i]*span[i] for i, key in enumerate(keys) }, **{ key: np.full(len(u), value) for key, value in fixed.items() })
+        if grid is None:
+            _, T, _ = ear_muff_sweep(designs, frequencies, terms, offset, absorber, **sweep_kwargs)
+        else:
+            T = modelgrid.to_measurement(grid, ear_muff_sweep(designs, grid, terms, offset, absorber, **sweep_kwargs)[1], frequencies)
+        return occlusion_objective(T, T_ref, target)
+
+    u = u0.copy()
+    m = np.zeros_like(u)
+    v = np.zeros_like(u)
+    best_u = u.copy()
+    best_value = np.full(n_starts, np.inf)
+
+    for iteration in range(1, iterations + 1):
+        # Perturb downwards at the upper bound so that all points stay feasible
+        h = np.where(u + fd_step <= 1, fd_step, -fd_step)
+        batch = np.repeat(u[:, None, :], n_params + 1, axis=1)
+        batch[:, 1:, :] += np.eye(n_params)[None] * h[:, None, :]
+        values = evaluate(batch.reshape(-1, n_params)).reshape(n_starts, n_params + 1)
+
+        improved = values[:, 0] < best_value
+        best_value[improved] = values[improved, 0]
+        best_u[improved] = u[improved]
+
+        grad = (values[:, 1:] - values[:, :1]) / h
+        m = 0.9*m + 0.1*grad
+        v = 0.999*v + 0.001*grad**2
+        delta = step * (m / (1 - 0.9**iteration)) / (np.sqrt(v / (1 - 0.999**iteration)) + 1e-12)
+        u_new = np.clip(u - delta, 0, 1)
+
+        if np.max(np.abs(u_new - u)) < tol:
+            break
+        u = u_new
+
+    values = evaluate(u)
+    improved = values < best_value
+    best_value[improved] = values[improved]
+    best_u[improved] = u[improved]
+
+    return lo + best_u*span, best_value
+
+def fit_ear_muff(bounds, fixed, frequencies, terms, offset, absorber, T_ref, target = None, n_starts = 8, iterations = 100, step = 0.05, fd_step = 1e-4, tol = 1e-5, seed = None, workers = 1, grid = None, **sweep_kwargs):
+    '''
+    Fits cup/absorber geometry and absorber parameters within bounds, either minimizing the occlusion effect
+    T / T_ref or matching a target occlusion curve. Starts are evaluated together in batched sweeps;
+    with workers > 1 they are split over a process pool (absorber must then be picklable).
+
+    Parameters:
+    - bounds (dict): Free parameter name -> (lower, upper)
+    - fixed (dict): Remaining parameter name -> value; bounds and fixed must cover geometry_keys and absorber_keys
+    - T_ref (np.ndarray): Open ear transfer function
+    - target (np.ndarray): Target occlusion curve (magnitude), None to minimize the occlusion effect
+    - n_starts (int): Number of starts, the first one in the center of the bounds, the others random
+    - workers (int): Number of processes, None uses all cores
+    - grid (np.ndarray): Model grid to sweep on (terms and offset given on it, see modelgrid.py), the transfer
+      functions are interpolated onto frequencies (the grid of T_ref and target) for the objective
+
+    Returns:
+    - (dict, float, (dict, np.ndarray)): Best design, its objective value and the final design table and values of all starts
+    '''
+    keys = list(bounds)
+    missing = set(geometry_keys + absorber_keys) - set(keys) - set(fixed)
+    if missing:
+        raise ValueError(f'No bounds or fixed values for {sorted(missing)}')
+
+    rng = np.random.default_rng(seed)
+    u0 = rng.random((n_starts, len(keys)))
+    u0[0] = 0.5
+
+    args = (keys, bounds, fixed, frequencies, terms, offset, absorber, T_ref, target, iterations, step, fd_step, tol, grid, sweep_kwargs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers > 1 and n_starts > 1:
+        groups = [ group for group in np.array_split(u0, min(workers, n_starts)) if len(group) ]
+        with ProcessPoolExecutor(max_workers=len(groups)) as pool:
+            results = list(pool.map(descend, groups, *( [arg]*len(groups) for arg in args )))
+        x = np.concatenate([ result[0] for result in results ])
+        values = np.concatenate([ result[1] for result in results ])
+    else:
+        x, values = descend(u0, *args)
+
+    table = { key: x[:, i] for i, key in enumerate(keys) }
+    best = int(np.argmin(values))
+    best_design = { key: float(table[key][best]) for key in keys } | { key: float(value) for key, value in fixed.items() }
+
+    return best_design, float(values[best]), (table, values)
@@ -0,0 +1,80 @@
+import os
+import json
+
+import numpy as np
+
+## Result export
+# Results are a flat dict of arrays (name -> np.ndarray) plus a JSON serializable metadata dict.
+# Formats, chosen by the file extension:
+# - '.npz': single NumPy archive, metadata stored as JSON string under 'metadata'
+# - '.h5'/'.hdf5': HDF5 file (requires h5py), one dataset per array, metadata as JSON attribute
+# - anything else: directory with one memory-mappable '<name>.npy' per array and 'metadata.json'
+
+def result_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npz':
+        return 'npz'
+    if ext in ('.h5', '.hdf5'):
+        return 'h5'
+    return 'npy'
+
+def write_results(path, arrays, metadata):
+    '''
+    Writes result arrays and metadata to path, see above for the formats
+    '''
+    fmt = result_format(path)
+    metadata_json = json.dumps(metadata)
+
+    if fmt == 'npz':
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez(path, metadata=np.array(metadata_json), **arrays)
+
+    elif fmt == 'h5':
+        try:
+            import h5py
+        except ImportError as e:
+            raise ImportError('HDF5 export requires h5py, use .npz or a directory instead') from e
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with h5py.File(path, 'w') as f:
+            for name, data in arrays.items():
+                f.create_dataset(name, data=data)
+            f.attrs['metadata'] = metadata_json
+
+    else:
+        os.makedirs(path, exist_ok=True)
+        for name, data in arrays.items():
+            np.save(os.path.join(path, f'{name}.npy'), data)
+        with open(os.path.join(path, 'metadata.json'), 'w') as f:
+            f.write(metadata_json)
+
+    print(f'Exported: {path}')
+
+def read_results(path, mmap = True):
+    '''
+    Reads results written by write_results. Arrays of the '.npy' directory format are memory mapped if mmap is set.
+
+    Returns:
+    - (dict, dict): Arrays and metadata
+    '''
+    fmt = result_format(path)
+
+    if fmt == 'npz':
+        with np.load(path) as npz:
+            arrays = { name: npz[name] for name in npz.files if name != 'metadata' }
+            metadata = json.loads(str(npz['metadata']))
+
+    elif fmt == 'h5':
+        import h5py
+        with h5py.File(path, 'r') as f:
+            arrays = { name: f[name][()] for name in f }
+            metadata = json.loads(f.attrs['metadata'])
+
+    else:
+        arrays = {}
+        for file in sorted(os.listdir(path)):
+            if file.endswith('.npy'):
+                arrays[file[:-4]] = np.load(os.path.join(path, file), mmap_mode='r' if mmap else None)
+        with open(os.path.join(path, 'metadata.json'), 'r') as f:
+            metadata = json.load(f)
+
+    return arrays, metadata
@@ -0,0 +1,140 @@
+import io
+import json
+import time
+import functools
+import contextlib
+
+import cache
+import model
+import resample
+
+## Instrumentation
+# Stage timers (wall time and number of calls per stage) and counters of the work done. Parse workers in other
+# processes collect their counters with collect() and the caller merges them, see readers.read_cropped_many.
+# report() summarizes both together with the cache, resampling and memoization statistics of the other modules.
+# Optional hooks: cProfile (start_profile / stop_profile) and tracemalloc (start_memory_trace / memory_report).
+timings = {}
+counters = {'files_parsed': 0, 'rows_parsed': 0, 'bytes_read': 0, 'pyfar_objects': 0}
+started = time.perf_counter()
+
+profiler = None
+
+def count(name, n = 1):
+    counters[name] = counters.get(name, 0) + n
+
+def merge(collected):
+    '''
+    Adds counters collected elsewhere (e.g. in a worker process)
+    '''
+    for name, n in collected.items():
+        count(name, n)
+
+@contextlib.contextmanager
+def collect():
+    '''
+    Counts into a fresh dict for the duration of the block and yields it, the global counters are left untouched
+    '''
+    global counters
+    outer = counters
+    counters = dict.fromkeys(outer, 0)
+    try:
+        yield counters
+    finally:
+        counters = outer
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Times the block as stage name
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = timings.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        entry['seconds'] += time.perf_counter() - start
+        entry['calls'] += 1
+
+def timed(func):
+    '''
+    Times every call of func as a stage named after the function
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def reset():
+    global started
+    timings.clear()
+    for name in counters:
+        counters[name] = 0
+    started = time.perf_counter()
+
+def summary():
+    '''
+    Returns:
+    - dict: 'total_seconds', 'stages', 'counters', 'cache', 'resample' and 'memo' statistics
+    '''
+    return {
+        'total_seconds': time.perf_counter() - started,
+        'stages': { name: dict(entry) for name, entry in timings.items() },
+        'counters': dict(counters),
+        'cache': dict(cache.stats),
+        'resample': dict(resample.stats),
+        'memo': { name: dict(entry) for name, entry in model.memo_stats.items() },
+    }
+
+def report(path = None):
+    '''
+    Prints the run summary, and writes it as JSON to path if given
+    '''
+    result = summary()
+
+    print(f"MESSAGE: Run report ({result['total_seconds']:.2f} s)")
+    for name, entry in result['stages'].items():
+        print(f"  {name:<32} {entry['seconds']*1e3:10.1f} ms  ({entry['calls']} calls)")
+    print('  ' + ', '.join( f'{name}: {n}' for name, n in result['counters'].items() ))
+    print(f"  cache hits: {result['cache']['hits']}, misses: {result['cache']['misses']}, interpolations: {result['resample']['files']}")
+
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f'Saved: {path}')
+
+def start_profile():
+    global profiler
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+def stop_profile(path = None, top = 20):
+    '''
+    Stops the profiler, prints the top functions by cumulative time and dumps the stats to path (for pstats/snakeviz)
+    '''
+    global profiler
+    import pstats
+    profiler.disable()
+    if path is not None:
+        profiler.dump_stats(path)
+        print(f'Saved: {path}')
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+    print(out.getvalue())
+    profiler = None
+
+def start_memory_trace():
+    import tracemalloc
+    tracemalloc.start()
+
+def memory_report(top = 10):
+    '''
+    Prints the current and peak traced memory and the lines with the largest allocations, then stops tracing
+    '''
+    import tracemalloc
+    current, peak = tracemalloc.get_traced_memory()
+    print(f'MESSAGE: Memory: {current / 2**20:.1f} MiB current, {peak / 2**20:.1f} MiB peak')
+    for entry in tracemalloc.take_snapshot().statistics('lineno')[:top]:
+        print(f'  {entry}')
+    tracemalloc.stop()
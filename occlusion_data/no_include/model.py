@@ -0,0 +1,206 @@
+import hashlib
+import functools
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+import network
+
+## Memoization of model components
+# Entries are keyed on the digest of all array arguments (frequency grid, wave numbers) and the scalar
+# geometry and medium parameters. Cached arrays are read-only since they are shared between callers.
+memo_maxsize = 128
+memo_stats = {}
+
+def memo_key(value):
+    '''
+    Hashable key of a function argument, arrays are represented by shape, dtype and SHA-1 of their data
+    '''
+    if isinstance(value, np.ndarray):
+        return (value.shape, value.dtype.str, hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest())
+    return value
+
+def freeze(value):
+    '''
+    Marks cached arrays (or tuples of arrays) read-only
+    '''
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, tuple):
+        for item in value:
+            freeze(item)
+    return value
+
+def memoize(func):
+    '''
+    LRU memoization for functions of arrays and scalars, bounded by memo_maxsize entries per function.
+    Hits and misses are counted in memo_stats[func.__name__].
+    '''
+    entries = OrderedDict()
+    stats = memo_stats.setdefault(func.__name__, {'hits': 0, 'misses': 0})
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = tuple(memo_key(arg) for arg in args) + tuple((name, memo_key(arg)) for name, arg in sorted(kwargs.items()))
+        if key in entries:
+            entries.move_to_end(key)
+            stats['hits'] += 1
+            return entries[key]
+
+        stats['misses'] += 1
+        result = freeze(func(*args, **kwargs))
+        entries[key] = result
+        while len(entries) > memo_maxsize:
+            entries.popitem(last=False)
+        return result
+
+    wrapper.cache_clear = entries.clear
+    return wrapper
+
+
+## Lumped ear canal model in closed form
+# The volume velocity source (EC walls) sits between the upstream section K_u, loaded by the EC entrance
+# impedance Z, and the downstream section K_d, terminated by the eardrum Z_tm:
+#
+#   T = ( create_shunt_admittance( 1 / K_u.input_impedance(Z) ) @ K_d ).transfer_function( (1, 1), Z_tm )
+#
+# With Y = 1 / K_u.input_impedance(Z), the cascade has C = Y*A_d + C_d and D = Y*B_d + D_d, so
+#
+#   T = 1 / ( Y*(A_d*Z_tm + B_d) + (C_d*Z_tm + D_d) ) = 1 / ( Y*P + Q )
+#
+# P and Q do not depend on the load and are computed once per model.
+EarCanalTerms = namedtuple('EarCanalTerms', ['A_u', 'B_u', 'C_u', 'D_u', 'P', 'Q', 'frequencies'])
+
+def ear_canal_terms(K_u, K_d, Z_tm, frequencies):
+    '''
+    Precomputes the load independent terms of the ear canal model
+
+    Parameters:
+    - K_u ((A, B, C, D)): Upstream EC section (to the entrance), see transmission_line
+    - K_d ((A, B, C, D)): Downstream EC section (to the eardrum)
+    - Z_tm (np.ndarray): Eardrum impedance
+    - frequencies (np.ndarray): Frequency vector in Hz
+
+    Returns:
+    - EarCanalTerms
+    '''
+    A_u, B_u, C_u, D_u = K_u
+    A_d, B_d, C_d, D_d = K_d
+
+    return EarCanalTerms(A_u, B_u, C_u, D_u, A_d*Z_tm + B_d, C_d*Z_tm + D_d, frequencies)
+
+def line_abcd(k, length, Area, Z_eq):
+    '''
+    A, B, C, D entries of an acoustic transmission line (pressure, volume velocity), broadcast over all inputs
+    '''
+    cos = np.cos(k*length)
+    sin = np.sin(k*length)
+    return cos, 1j*(Z_eq/Area)*sin, 1j/(Z_eq/Area)*sin, cos
+
+@memoize
+def transmission_line(k, length, Area, Z_eq):
+    '''
+    Memoized line_abcd for the fixed sections of the model (ear canal, pinna)
+    '''
+    return line_abcd(k, length, Area, Z_eq)
+
+# Shaw & Stinson (1983) eardrum network, parameters given in Fig. 7 in Schroeter & Pösselt (1986)
+eardrum_parameters = {
+    'K': 9, 'L_a': 2e3, 'R_a': 1e6, 'C_p': 5.1e-11, 'C_t': 3.5e-12, 'R_m': 2e7, 'C_do': 2e-12, 'R_do': 1.7e7,
+    'L_d': 1.2e3, 'C_d': 3e-11, 'R_d': 1e6, 'L_o': 3e5, 'C_o': 1.5e-13, 'R_o': 9e8, 'C_s': 2.7e-14, 'R_s': 3e10,
+    'L_c': 2e5, 'C_c': 5e-14, 'R_c': 6e9,
+}
+
+def eardrum_description():
+    '''
+    Shaw & Stinson (1983) eardrum network as a network description (see network.py), parameters named
+    as in eardrum_parameters
+    '''
+    # Implementation taken from Kersten et. al (2024), DOI: 10.1121/10.0024244
+    R, L, C, series, parallel = network.R, network.L, network.C, network.series, network.parallel
+
+    Z_ap = series(C('C_p'), L('L_a'), R('R_a'))
+    Z_cav = parallel(Z_ap, C('C_t'), R('R_m'))
+    Z_do = series(R('R_do'), C('C_do'))
+    Z_d = series(R('R_d'), L('L_d'), C('C_d'))
+    Z_s = series(R('R_s'), C('C_s'))
+    Z_c = series(R('R_c'), L('L_c'), C('C_c'))
+    Z_o = series(R('R_o'), L('L_o'), C('C_o'), parallel(Z_s, Z_c))
+
+    # Ossicular coupling through the lever ratio K is a bridge, not a ladder, so it is written out
+    K = network.param('K')
+    Z_K = (Z_o*Z_do + Z_o*Z_d + K*K*Z_do*Z_d)/(Z_o+Z_d+(1+K)**2*Z_do)
+    return series(Z_cav, Z_K)
+
+eardrum = network.compile_network({'Z_tm': eardrum_description()})
+
+def eardrum_network(frequencies, **params):
+    '''
+    Eardrum impedance for arbitrary network parameters (defaults from eardrum_parameters), broadcast over
+    all inputs, e.g. parameter arrays of shape (n, 1) give n impedances
+    '''
+    return eardrum(frequencies, **(eardrum_parameters | params))['Z_tm']
+
+@memoize
+def eardrum_impedance(frequencies):
+    # after Shaw & Stinson (1983)
+    # parameters given in Fig. 7 in Schroeter & Pösselt (1986)
+    return eardrum_network(frequencies)
+
+# Shared with the code generated for compiled networks
+input_impedance = network.zin
+
+## Outer ear as a network description
+# The closed form above, written with network.py elements: K_u loaded by the entrance impedance 'Z_load'
+# (times 'offset') is a shunt at the source, followed by K_d and the eardrum. Compiling it hoists P and Q
+# into prepare by itself. Alternative ear canal or ear muff topologies are described the same way; sim.py
+# evaluates whatever network sim.ear_network holds, it needs the outputs 'T' and 'Z_in' and the loads
+# 'Z_load' and 'offset'.
+def outer_ear_description(Z_tm = None):
+    '''
+    Parameters:
+    - Z_tm (network.Node): Eardrum, None uses eardrum_description
+
+    Returns:
+    - dict: 'T' (transfer function EC wall to TM) and 'Z_in' (input impedance of K_u without offset),
+      parameters l_u, l_d, S_ec, c, Z0 and those of the eardrum
+    '''
+    Z_in = network.input_impedance( network.line('l_u', 'S_ec'), network.load('Z_load') )
+    ear_canal = network.cascade( network.shunt_arm( Z_in * network.load('offset') ), network.line('l_d', 'S_ec') )
+    return {
+        'T': network.transfer_function( ear_canal, eardrum_description() if Z_tm is None else Z_tm ),
+        'Z_in': Z_in,
+    }
+
+outer_ear = network.compile_network(outer_ear_description())
+
+@memoize
+def prepare_network(ear_network, frequencies, **params):
+    '''
+    Memoized ear_network.prepare, keyed on the network, the digest of the grid and the parameters. The prepared
+    values are read-only, evaluate does not write to them.
+    '''
+    return ear_network.prepare(frequencies, **params)
+
+def transfer_functions(Z_load, terms, offset = 1):
+    '''
+    Evaluates the transfer function between EC wall and TM for a stack of EC entrance impedances at once
+
+    Parameters:
+    - Z_load (np.ndarray): Entrance impedances, shape (n_freqs,) or (n_measurements, n_freqs)
+    - terms (EarCanalTerms or network.Prepared): Load independent terms, see ear_canal_terms, or a prepared
+      network with the outputs and loads of outer_ear_description
+    - offset (float or np.ndarray): Factor applied to the input impedance of K_u (e.g. pinna offset)
+
+    Returns:
+    - np.ndarray: Transfer functions with the shape of Z_load
+    '''
+    if isinstance(terms, network.Prepared):
+        return network.evaluate(terms, Z_load = Z_load, offset = offset)['T']
+
+    Z_in = input_impedance(terms.A_u, terms.B_u, terms.C_u, terms.D_u, Z_load) * offset
+
+    denominator = (1 / Z_in) * terms.P + terms.Q
+    denominator[denominator == 0] = np.finfo(float).eps
+
+    return 1 / denominator
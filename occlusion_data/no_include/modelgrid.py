@@ -0,0 +1,117 @@
+import numpy as np
+
+import resample
+
+## Model grid
+# The lumped model is smooth, so pure simulations (perfect occlusion, ear muff designs, sweeps and fits) do not
+# need the ~0.34 Hz grid inherited from the reference measurement. Modes:
+# - 'measurement': simulate on the measurement grid itself (default, no interpolation)
+# - 'log': points_per_decade log-spaced points spanning the measurement grid
+# - 'adaptive': log grid with initial_points_per_decade, intervals are bisected (at the geometric mean) while the
+#   interpolated result deviates from the simulation at the midpoint by more than tolerance_db
+# Results are interpolated linearly onto the measurement grid (real and imaginary part) by to_measurement, only
+# where they are combined with measured data. Grids finer than the measurement grid fall back to it.
+mode = 'measurement'
+points_per_decade = 200
+initial_points_per_decade = 24
+tolerance_db = 0.05
+max_levels = 10
+
+def log_grid(f_min, f_max, points_per_decade):
+    '''
+    Log-spaced grid from f_min to f_max (both included) with points_per_decade points per decade
+    '''
+    n_points = max(2, int(np.ceil(np.log10(f_max / f_min) * points_per_decade)) + 1)
+    return np.geomspace(f_min, f_max, n_points)
+
+def deviation_db(exact, interpolated):
+    '''
+    Largest deviation per frequency over all leading axes as 20*log10(1 + |exact - interpolated| / |exact|)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.abs(exact - interpolated) / np.abs(exact)
+    relative = np.nan_to_num(relative, nan=0, posinf=np.inf).reshape(-1, relative.shape[-1])
+    return 20*np.log10(1 + relative.max(axis=0))
+
+def refine(evaluate, grid, tolerance = None, levels = None):
+    '''
+    Adaptive refinement of a grid by bisection
+
+    Parameters:
+    - evaluate (callable): evaluate(grid) -> np.ndarray (..., len(grid)), e.g. transfer functions of a sweep
+    - grid (np.ndarray): Initial ascending grid
+    - tolerance (float): Allowed interpolation error at interval midpoints in dB, None uses tolerance_db
+    - levels (int): Maximum number of bisections of an interval, None uses max_levels
+
+    Returns:
+    - (np.ndarray, np.ndarray): Refined grid and evaluate on it
+    '''
+    tolerance = tolerance_db if tolerance is None else tolerance
+    levels = max_levels if levels is None else levels
+    grid = np.asarray(grid, dtype=np.float64)
+    values = evaluate(grid)
+    active = np.ones(len(grid) - 1, dtype=bool)
+
+    for _ in range(levels):
+        intervals = np.flatnonzero(active)
+        if not len(intervals):
+            break
+        mids = np.sqrt(grid[intervals] * grid[intervals + 1])
+        mid_values = evaluate(mids)
+        interpolated = resample.apply_table(resample.interp_table(grid, mids), values, 'realimag')
+        split = deviation_db(mid_values, interpolated) > tolerance
+
+        # Insert the midpoints of the intervals that failed, only their halves are checked again
+        order = np.argsort(np.concatenate((grid, mids[split])), kind='stable')
+        is_new = np.concatenate((np.zeros(len(grid), dtype=bool), np.ones(split.sum(), dtype=bool)))[order]
+        grid = np.concatenate((grid, mids[split]))[order]
+        values = np.concatenate((values, mid_values[..., split]), axis=-1)[..., order]
+        active = is_new[:-1] | is_new[1:]
+
+    return grid, values
+
+def initial_grid(frequencies):
+    f_min = frequencies[frequencies > 0][0]
+    return log_grid(f_min, frequencies[-1], points_per_decade if mode == 'log' else initial_points_per_decade)
+
+def model_grid(frequencies, evaluate = None):
+    '''
+    Model grid for the measurement grid frequencies in the current mode
+
+    Parameters:
+    - frequencies (np.ndarray): Measurement grid
+    - evaluate (callable): Simulation driving the refinement in mode 'adaptive', see refine
+
+    Returns:
+    - (np.ndarray, np.ndarray): Model grid and evaluate on it (None if evaluate was not needed)
+    '''
+    frequencies = np.asarray(frequencies)
+    if mode not in ('measurement', 'log', 'adaptive'):
+        raise ValueError(f"Unknown model grid '{mode}', use 'measurement', 'log' or 'adaptive'")
+    if mode == 'measurement' or len(frequencies) < 2:
+        return frequencies, None
+
+    grid, values = initial_grid(frequencies), None
+    if mode == 'adaptive':
+        grid, values = refine(evaluate, grid)
+    if len(grid) >= len(frequencies):
+        return frequencies, None
+    return grid, values
+
+def to_measurement(grid, data, frequencies):
+    '''
+    Interpolates data (..., len(grid)) simulated on the model grid onto the measurement grid frequencies
+    '''
+    if grid is frequencies or np.array_equal(grid, frequencies):
+        return data
+    return resample.apply_table(resample.get_table(grid, frequencies), data, 'realimag')
+
+def simulate(evaluate, frequencies):
+    '''
+    Runs a pure simulation evaluate(grid) -> np.ndarray (..., len(grid)) on the model grid and returns it
+    on the measurement grid frequencies
+    '''
+    grid, values = model_grid(frequencies, evaluate)
+    if values is None:
+        values = evaluate(grid)
+    return to_measurement(grid, values, frequencies)
@@ -0,0 +1,201 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import model
+import stats
+
+## Monte Carlo uncertainty propagation
+# The ear canal geometry (l_ec, r_ec, l_c), the pinna offset in dB and the eardrum network parameters
+# (model.eardrum_parameters) are drawn from distributions, e.g. read from a JSON file:
+#
+#   { "l_ec": {"dist": "normal", "mean": 27.7e-3, "std": 2e-3, "low": 20e-3},
+#     "r_ec": {"dist": "uniform", "low": 3.5e-3, "high": 4.2e-3},
+#     "pinna_offset_db": {"dist": "triangular", "left": 5, "mode": 7, "right": 9},
+#     "R_a": {"dist": "lognormal", "median": 1e6, "sigma": 0.3} }
+#
+# Parameters that are not listed keep their nominal value. The occlusion effect T / T_ref of every curve is
+# evaluated for chunk samples at once (arrays (chunk, n_curves, n_freqs)) and accumulated in dB in one
+# stats.RunningStats, so only mean, std and a histogram per curve and frequency are kept, never the samples.
+# The histogram spans the nominal effect +- margin_db (widened where samples fall outside), workers fill
+# accumulators with that same range and the caller merges them. Percentile resolution is 2*margin_db/bins dB
+# (0.16 dB), the histogram takes n_curves * n_freqs * bins * 4 bytes per worker (about 32 MB for 15 curves
+# on 4161 frequencies).
+chunk = 32
+bins = 128
+margin_db = 10
+hist_dtype = np.int32
+
+distribution_keys = {
+    'fixed': ('value',),
+    'normal': ('mean', 'std'),
+    'uniform': ('low', 'high'),
+    'lognormal': ('median', 'sigma'),
+    'triangular': ('left', 'mode', 'right'),
+}
+
+def parameter_names():
+    return ('l_ec', 'r_ec', 'l_c', 'pinna_offset_db') + tuple(model.eardrum_parameters)
+
+def check_distributions(distributions):
+    '''
+    Raises ValueError for unknown parameters, distributions or missing distribution arguments
+    '''
+    for name, spec in distributions.items():
+        if name not in parameter_names():
+            raise ValueError(f"Unknown parameter '{name}', use one of {', '.join(parameter_names())}")
+        if not isinstance(spec, dict):
+            continue
+        dist = spec.get('dist')
+        if dist not in distribution_keys:
+            raise ValueError(f"Unknown distribution '{dist}' for '{name}', use one of {', '.join(distribution_keys)}")
+        missing = [ key for key in distribution_keys[dist] if key not in spec ]
+        if missing:
+            raise ValueError(f"Distribution '{dist}' of '{name}' needs {', '.join(missing)}")
+
+def draw(spec, n, rng):
+    '''
+    Draws n values of one parameter. A number is a fixed value; normal and lognormal distributions
+    may be truncated to [low, high] (rejected values are drawn again).
+
+    Returns:
+    - np.ndarray: (n,)
+    '''
+    if not isinstance(spec, dict):
+        return np.full(n, float(spec))
+
+    dist = spec['dist']
+    if dist == 'fixed':
+        return np.full(n, float(spec['value']))
+    if dist == 'uniform':
+        return rng.uniform(spec['low'], spec['high'], n)
+    if dist == 'triangular':
+        return rng.triangular(spec['left'], spec['mode'], spec['right'], n)
+
+    def raw(size):
+        if dist == 'normal':
+            return rng.normal(spec['mean'], spec['std'], size)
+        return spec['median'] * np.exp(rng.normal(0, spec['sigma'], size))
+
+    low, high = spec.get('low', -np.inf), spec.get('high', np.inf)
+    values = raw(n)
+    rejected = (values < low) | (values > high)
+    for _ in range(100):
+        if not rejected.any():
+            break
+        values[rejected] = raw(rejected.sum())
+        rejected = (values < low) | (values > high)
+    return np.clip(values, low, high)
+
+def sample(distributions, nominal, n, rng):
+    '''
+    Draws n parameter sets
+
+    Parameters:
+    - distributions (dict): Parameter name -> distribution (see the module comment) or fixed value
+    - nominal (dict): Values of all parameter_names(), used for parameters without distribution
+    - n (int): Number of samples
+    - rng (np.random.Generator)
+
+    Returns:
+    - dict: Parameter name -> np.ndarray (n,)
+    '''
+    return { name: draw(distributions.get(name, nominal[name]), n, rng) for name in parameter_names() }
+
+def occlusion_effect(values, frequencies, Z_meas, Z_ref, Z_boxes = None, c = 343, rho0 = 1.2, ear_network = model.outer_ear):
+    '''
+    Evaluates the ear canal model for a set of parameter samples at once
+
+    Parameters:
+    - values (dict): Parameter name -> np.ndarray (n,), see sample
+    - frequencies (np.ndarray): Frequency vector in Hz (n_freqs,)
+    - Z_meas (np.ndarray): Measured entrance impedances (n_meas, n_freqs), not yet divided by the EC area
+    - Z_ref (np.ndarray): Reference (open ear) impedance (n_freqs,), not yet divided by the EC area
+    - Z_boxes (np.ndarray): Simulated ear muff load impedances (n_boxes, n_freqs), the pinna offset is applied
+    - ear_network (network.CompiledNetwork): EC network (sim.ear_network), prepared with the sampled parameters
+      l_u, l_d, S_ec, c, Z0 and those of model.eardrum_parameters
+
+    Returns:
+    - np.ndarray: T / T_ref, (n, n_meas + 1 + n_boxes, n_freqs), the extra curve is the perfect occlusion
+    '''
+    l_ec, r_ec, l_c, offset_db = ( values[name][:, None, None] for name in ('l_ec', 'r_ec', 'l_c', 'pinna_offset_db') )
+    S_ec = np.pi*r_ec**2
+
+    params = {'l_u': l_c, 'l_d': l_ec - l_c, 'S_ec': S_ec, 'c': c, 'Z0': rho0*c} | { name: values[name][:, None, None] for name in model.eardrum_parameters }
+    terms = ear_network.prepare(frequencies, **params)
+
+    T_ref = model.transfer_functions( Z_ref / S_ec, terms )
+    curves = [ model.transfer_functions( Z_meas / S_ec, terms ), model.transfer_functions( np.inf*frequencies[None], terms ) ]
+    if Z_boxes is not None and len(Z_boxes):
+        curves.append( model.transfer_functions( Z_boxes, terms, 10**(offset_db/20) ) )
+
+    return np.concatenate(curves, axis=1) / T_ref
+
+def accumulate(seed, n_samples, distributions, nominal, frequencies, Z_meas, Z_ref, Z_boxes, range_db, percentiles, c, rho0, ear_network):
+    '''
+    Draws and evaluates n_samples in chunks of chunk samples (runs in a worker with workers > 1)
+
+    Returns:
+    - stats.RunningStats: Accumulated occlusion effect over (n_curves * n_freqs) columns in dB
+    '''
+    rng = np.random.default_rng(seed)
+    running = stats.RunningStats('db', percentiles, bins = bins, range_db = range_db, dtype = hist_dtype)
+    for start in range(0, n_samples, chunk):
+        values = sample(distributions, nominal, min(chunk, n_samples - start), rng)
+        effect = occlusion_effect(values, frequencies, Z_meas, Z_ref, Z_boxes, c, rho0, ear_network)
+        running.update(effect.reshape(len(effect), -1))
+    return running
+
+def propagate(distributions, nominal, frequencies, Z_meas, Z_ref, Z_boxes = None, n_samples = 10000, percentiles = (5, 50, 95), seed = None, workers = 1, c = 343, rho0 = 1.2, ear_network = model.outer_ear):
+    '''
+    Propagates the parameter distributions to percentile bands of the occlusion effect of every curve
+
+    Parameters:
+    - distributions (dict): Parameter name -> distribution, see the module comment
+    - nominal (dict): Nominal values of all parameter_names()
+    - frequencies, Z_meas, Z_ref, Z_boxes, ear_network: See occlusion_effect
+    - n_samples (int): Number of Monte Carlo samples
+    - percentiles (tuple): Percentiles in %
+    - seed (int): Seed of the random generator, None for a random run
+    - workers (int): Number of processes, None uses all cores
+
+    Returns:
+    - dict: 'count', 'nominal_db', 'mean_db', 'std_db' (n_curves, n_freqs) and 'percentiles_db' (percentile -> (n_curves, n_freqs))
+    '''
+    check_distributions(distributions)
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    Z_meas = np.atleast_2d(np.asarray(Z_meas, dtype=np.complex128))
+
+    # Nominal effect sets the histogram range, every worker uses the same one so the histograms can be added
+    nominal_values = { name: np.array([float(nominal[name])]) for name in parameter_names() }
+    nominal_db = stats.magnitude(occlusion_effect(nominal_values, frequencies, Z_meas, Z_ref, Z_boxes, c, rho0, ear_network)[0], 'db')
+    center = np.nan_to_num(nominal_db, nan=0, posinf=0, neginf=0).reshape(-1)
+    range_db = (center - margin_db, center + margin_db)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, -(-n_samples // chunk)))
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    shares = [ len(part) for part in np.array_split(np.arange(n_samples), workers) ]
+    args = (distributions, nominal, frequencies, Z_meas, Z_ref, Z_boxes, range_db, percentiles, c, rho0, ear_network)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(accumulate, seeds, shares, *( [arg]*workers for arg in args )))
+    else:
+        parts = [ accumulate(seeds[0], n_samples, *args) ]
+
+    running = parts[0]
+    for part in parts[1:]:
+        running.merge(part)
+
+    shape = nominal_db.shape
+    result = running.result()
+    return {
+        'count': result['count'],
+        'nominal_db': nominal_db,
+        'mean_db': result['mean'].reshape(shape),
+        'std_db': result['std'].reshape(shape),
+        'percentiles_db': { q: values.reshape(shape) for q, values in result['percentiles'].items() },
+    }
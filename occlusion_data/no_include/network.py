@@ -0,0 +1,477 @@
+from collections import namedtuple
+
+import numpy as np
+
+## Lumped element network compiler
+# A network is described declaratively by impedance expressions (R, L, C, series, parallel and arithmetic on them)
+# and two-ports (series_arm, shunt_arm, line, cascade), e.g. the ear canal of model.py:
+#
+#   Z_in = input_impedance( line('l_u', 'S_ec'), load('Z_load') )
+#   canal = cascade( shunt_arm( Z_in * load('offset') ), line('l_d', 'S_ec') )
+#   outer_ear = compile_network({ 'T': transfer_function(canal, eardrum), 'Z_in': Z_in })
+#
+# Strings are parameters, bound once per frequency grid by prepare; load() values are given per evaluation.
+# compile_network turns the expression graph into two generated NumPy functions:
+# - constants are folded and identity elements (x*1, x+0, 1/(1/x), ...) removed while the graph is built
+# - equal subexpressions are evaluated once (the graph is hash-consed)
+# - expressions that are affine in one load dependent term are rewritten as term*coef + offset, so that coef and
+#   offset are hoisted into prepare (for the ear canal this gives T = 1/(Y*P + Q) with P, Q computed once)
+# - everything that does not depend on a load is computed in prepare, evaluate only runs the load dependent part
+#   and frees intermediate arrays after their last use
+# CompiledNetwork.source holds the generated code.
+
+class Node:
+    '''
+    Expression node: op with arguments (child nodes, constant value or parameter/load name). Nodes are immutable
+    and compare structurally, which merges equal subexpressions.
+    '''
+    __slots__ = ('op', 'args', 'hash')
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+        self.hash = hash((op, args))
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, Node) and self.hash == other.hash and self.op == other.op and self.args == other.args)
+
+    def __repr__(self):
+        return f'{self.op}{self.args}'
+
+    def __add__(self, other):
+        return make('add', self, wrap(other))
+
+    def __radd__(self, other):
+        return make('add', wrap(other), self)
+
+    def __sub__(self, other):
+        return make('sub', self, wrap(other))
+
+    def __rsub__(self, other):
+        return make('sub', wrap(other), self)
+
+    def __mul__(self, other):
+        return make('mul', self, wrap(other))
+
+    def __rmul__(self, other):
+        return make('mul', wrap(other), self)
+
+    def __truediv__(self, other):
+        return make('div', self, wrap(other))
+
+    def __rtruediv__(self, other):
+        return make('div', wrap(other), self)
+
+    def __neg__(self):
+        return make('neg', self)
+
+    def __pow__(self, exponent):
+        return make('pow', self, wrap(exponent))
+
+def const(value):
+    return Node('const', (value,))
+
+def param(name):
+    '''
+    Parameter bound by CompiledNetwork.prepare (scalar or array broadcasting against the frequencies)
+    '''
+    return Node('param', (name,))
+
+def load(name):
+    '''
+    Value given per call of CompiledNetwork.evaluate, e.g. a stack of load impedances
+    '''
+    return Node('load', (name,))
+
+def frequency():
+    return Node('freq', ())
+
+def wrap(value):
+    '''
+    Nodes are kept, strings become parameters and numbers constants
+    '''
+    if isinstance(value, Node):
+        return value
+    if isinstance(value, str):
+        return param(value)
+    return const(value)
+
+def is_const(node, value = None):
+    return node.op == 'const' and (value is None or node.args[0] == value)
+
+folding = {
+    'add': lambda a, b: a + b,
+    'sub': lambda a, b: a - b,
+    'mul': lambda a, b: a * b,
+    'div': lambda a, b: a / b,
+    'neg': lambda a: -a,
+    'pow': lambda a, b: a ** b,
+}
+
+def make(op, *args):
+    '''
+    Builds a node, folding constants and removing identity operations
+    '''
+    if op in folding and all( is_const(arg) for arg in args ):
+        return const(folding[op](*( arg.args[0] for arg in args )))
+
+    if op == 'add':
+        a, b = args
+        if is_const(a, 0):
+            return b
+        if is_const(b, 0):
+            return a
+    elif op == 'sub':
+        a, b = args
+        if is_const(b, 0):
+            return a
+        if is_const(a, 0):
+            return make('neg', b)
+    elif op == 'mul':
+        a, b = args
+        if is_const(a, 0) or is_const(b, 0):
+            return const(0)
+        if is_const(a, 1):
+            return b
+        if is_const(b, 1):
+            return a
+    elif op == 'div':
+        a, b = args
+        if is_const(b, 1):
+            return a
+        if is_const(a, 0):
+            return const(0)
+        if is_const(a, 1) and b.op == 'div' and is_const(b.args[0], 1):
+            return b.args[1]
+    elif op == 'neg' and args[0].op == 'neg':
+        return args[0].args[0]
+    elif op == 'pow' and is_const(args[1], 1):
+        return args[0]
+
+    return Node(op, args)
+
+## Elements
+def omega():
+    return 2*np.pi * frequency()
+
+def R(value):
+    return wrap(value)
+
+def L(value):
+    return 1j*omega() * wrap(value)
+
+def C(value):
+    return 1 / (1j*omega() * wrap(value))
+
+def series(*impedances):
+    total = wrap(impedances[0])
+    for impedance in impedances[1:]:
+        total = total + wrap(impedance)
+    return total
+
+def parallel(*impedances):
+    total = 1 / wrap(impedances[0])
+    for impedance in impedances[1:]:
+        total = total + 1 / wrap(impedance)
+    return 1 / total
+
+# Two-port as the entries of its transmission (ABCD) matrix, pressure and volume velocity
+TwoPort = namedtuple('TwoPort', ['A', 'B', 'C', 'D'])
+
+def series_arm(Z):
+    return TwoPort(const(1), wrap(Z), const(0), const(1))
+
+def shunt_arm(Z):
+    return TwoPort(const(1), const(0), 1 / wrap(Z), const(1))
+
+def line(length, area, Z0 = 'Z0', c = 'c'):
+    '''
+    Lossless transmission line (as model.line_abcd), wave number omega / c
+    '''
+    k = omega() / wrap(c)
+    kl = k * wrap(length)
+    Z = wrap(Z0) / wrap(area)
+    cos = make('cos', kl)
+    sin = make('sin', kl)
+    return TwoPort(cos, 1j*Z * sin, 1j/Z * sin, cos)
+
+def cascade(*two_ports):
+    A, B, C, D = two_ports[0]
+    for (A2, B2, C2, D2) in two_ports[1:]:
+        A, B, C, D = A*A2 + B*C2, A*B2 + B*D2, C*A2 + D*C2, C*B2 + D*D2
+    return TwoPort(A, B, C, D)
+
+def input_impedance(two_port, Z_load):
+    '''
+    Input impedance of a two-port terminated by Z_load (loads of inf are handled as in model.input_impedance)
+    '''
+    return make('zin', *two_port, wrap(Z_load))
+
+def transfer_function(two_port, Z_load):
+    '''
+    Transfer function 1 / (C*Z_load + D) of a terminated two-port, as model.transfer_functions
+    '''
+    return 1 / make('nonzero', two_port.C * wrap(Z_load) + two_port.D)
+
+## Runtime helpers of the generated code
+def zin(A, B, C, D, Z_load):
+    '''
+    Input impedance (A*Z + B) / (C*Z + D) of a two-port for a stack of loads, with the same handling
+    of Z = inf and zero denominators as pf.TransmissionMatrix.input_impedance
+    '''
+    Z_load = np.asarray(Z_load, dtype=np.complex128)
+    is_inf = Z_load == np.inf
+
+    with np.errstate(invalid='ignore'):
+        nominator = A*Z_load + B
+        denominator = C*Z_load + D
+    nominator = np.where(is_inf, A, nominator)
+    denominator = np.where(is_inf, C, denominator)
+    denominator[denominator == 0] = np.finfo(float).eps
+
+    return nominator / denominator
+
+def nonzero(x):
+    '''
+    Replaces zeros (of an intermediate result, in place) by eps
+    '''
+    if isinstance(x, np.ndarray) and x.ndim:
+        x[x == 0] = np.finfo(float).eps
+        return x
+    return x if x != 0 else np.finfo(float).eps
+
+## Compiler
+Prepared = namedtuple('Prepared', ['network', 'values'])
+
+formats = {
+    'add': '{} + {}',
+    'sub': '{} - {}',
+    'mul': '{} * {}',
+    'div': '{} / {}',
+    'neg': '-{}',
+    'pow': '{} ** {}',
+    'cos': 'np.cos({})',
+    'sin': 'np.sin({})',
+    'zin': 'zin({}, {}, {}, {}, {})',
+    'nonzero': 'nonzero({})',
+}
+
+def literal(value):
+    if isinstance(value, complex) and not np.isfinite(value):
+        return f'complex({literal(value.real)}, {literal(value.imag)})'
+    if isinstance(value, float) and not np.isfinite(value):
+        return f"float('{value}')"
+    return repr(value)
+
+def hoist(outputs):
+    '''
+    Rewrites load dependent expressions that are affine in a single load dependent term as term*coef + offset
+    with load independent coef and offset
+
+    Returns:
+    - (dict, callable): Output name -> rewritten node, and the test whether a node depends on a load
+    '''
+    dependent_memo = {}
+    rewritten = {}
+    linear_memo = {}
+
+    def dependent(node):
+        if node not in dependent_memo:
+            dependent_memo[node] = node.op == 'load' or any( dependent(arg) for arg in node.args if isinstance(arg, Node) )
+        return dependent_memo[node]
+
+    def linear(node):
+        # (term, coef, offset) with node == term*coef + offset, None if node is not affine in a single term
+        if node in linear_memo:
+            return linear_memo[node]
+        if not dependent(node):
+            result = (None, const(0), node)
+        elif node.op in ('add', 'sub'):
+            a, b = linear(node.args[0]), linear(node.args[1])
+            if a is None or b is None or (a[0] is not None and b[0] is not None and a[0] != b[0]):
+                result = None
+            else:
+                result = (a[0] if a[0] is not None else b[0], make(node.op, a[1], b[1]), make(node.op, a[2], b[2]))
+        elif node.op == 'neg':
+            a = linear(node.args[0])
+            result = None if a is None else (a[0], -a[1], -a[2])
+        elif node.op == 'mul' and not (dependent(node.args[0]) and dependent(node.args[1])):
+            if dependent(node.args[0]):
+                a = linear(node.args[0])
+                scale = lambda x: x * node.args[1]
+            else:
+                a = linear(node.args[1])
+                scale = lambda x: node.args[0] * x
+            result = None if a is None else (a[0], scale(a[1]), scale(a[2]))
+        else:
+            result = None
+        if result is None and node.op not in ('add', 'sub', 'neg', 'mul'):
+            result = (rewrite_children(node), const(1), const(0))
+        linear_memo[node] = result
+        return result
+
+    def rewrite_children(node):
+        return make(node.op, *( rewrite(arg) if isinstance(arg, Node) else arg for arg in node.args )) if node.op in formats else node
+
+    def rewrite(node):
+        if node not in rewritten:
+            if not dependent(node):
+                rewritten[node] = node
+            else:
+                form = linear(node) if node.op in ('add', 'sub', 'neg', 'mul') else None
+                if form is None:
+                    rewritten[node] = rewrite_children(node)
+                else:
+                    term, coef, offset = form
+                    rewritten[node] = make('add', make('mul', term, coef), offset)
+        return rewritten[node]
+
+    return { name: rewrite(node) for name, node in outputs.items() }, dependent
+
+def generate(outputs):
+    '''
+    Generates the source of prepare(frequencies, params) and evaluate(values, loads) for the output nodes
+
+    Returns:
+    - (str, list, list): Source, parameter names and load names
+    '''
+    outputs, dependent = hoist(outputs)
+
+    # Topological order of the (merged) graph
+    order = []
+    visited = set()
+    def visit(node):
+        if node in visited or node.op == 'const':
+            return
+        for arg in node.args:
+            if isinstance(arg, Node):
+                visit(arg)
+        visited.add(node)
+        order.append(node)
+    for node in outputs.values():
+        if node.op == 'const':
+            continue
+        visit(node)
+
+    def operand(node):
+        return literal(node.args[0]) if node.op == 'const' else names[node]
+
+    def statement(node):
+        if node.op == 'param':
+            return f"{names[node]} = params[{node.args[0]!r}]"
+        if node.op == 'load':
+            return f"{names[node]} = loads[{node.args[0]!r}]"
+        if node.op == 'freq':
+            return f"{names[node]} = frequencies"
+        args = [ operand(arg) for arg in node.args ]
+        if node.op == 'nonzero' and node.args[0].op in ('param', 'load'):
+            args = [ f'np.array({args[0]})' ]
+        return f'{names[node]} = ' + formats[node.op].format(*args)
+
+    early = [ node for node in order if not dependent(node) ]
+    late = [ node for node in order if dependent(node) ]
+    names = { node: f't{i}' for i, node in enumerate(early + late) }
+
+    # Values passed from prepare to evaluate: load independent operands of the load dependent part and outputs
+    hoisted = []
+    for node in late:
+        for arg in node.args:
+            if isinstance(arg, Node) and arg.op != 'const' and not dependent(arg) and arg not in hoisted:
+                hoisted.append(arg)
+    for node in outputs.values():
+        if node.op != 'const' and not dependent(node) and node not in hoisted:
+            hoisted.append(node)
+
+    # Last use of every load dependent temporary, freed afterwards unless it is an output
+    last_use = {}
+    for i, node in enumerate(late):
+        for arg in node.args:
+            if isinstance(arg, Node) and arg in names and dependent(arg):
+                last_use[arg] = i
+    kept = set(outputs.values())
+
+    lines = ['def prepare(frequencies, params):']
+    lines += [ f'    {statement(node)}' for node in early ]
+    lines.append(f"    return ({''.join( names[node] + ', ' for node in hoisted )})")
+    lines.append('')
+    lines.append('def evaluate(values, loads):')
+    if hoisted:
+        lines.append(f"    {''.join( names[node] + ', ' for node in hoisted )}= values")
+    for i, node in enumerate(late):
+        lines.append(f'    {statement(node)}')
+        freed = [ names[arg] for arg, last in last_use.items() if last == i and arg not in kept ]
+        if freed:
+            lines.append(f"    del {', '.join(freed)}")
+    lines.append('    return {' + ', '.join( f'{name!r}: {operand(node)}' for name, node in outputs.items() ) + '}')
+
+    params = sorted({ node.args[0] for node in order if node.op == 'param' })
+    loads = sorted({ node.args[0] for node in order if node.op == 'load' })
+    return '\n'.join(lines) + '\n', params, loads
+
+class CompiledNetwork:
+    '''
+    Vectorized evaluator of a network description, see compile_network
+
+    Attributes:
+    - outputs (dict): Output name -> expression node as described
+    - params (list): Parameter names needed by prepare
+    - loads (list): Load names needed by evaluate
+    - source (str): Generated code
+    '''
+    def __init__(self, outputs):
+        self.outputs = dict(outputs)
+        self.source, self.params, self.loads = generate(self.outputs)
+        namespace = {'np': np, 'zin': zin, 'nonzero': nonzero}
+        exec(compile(self.source, '<network>', 'exec'), namespace)
+        self.prepare_values = namespace['prepare']
+        self.evaluate_values = namespace['evaluate']
+
+    def __reduce__(self):
+        # Generated functions cannot be pickled, workers compile the description again
+        return (compile_network, (self.outputs,))
+
+    def prepare(self, frequencies, **params):
+        '''
+        Evaluates everything that does not depend on a load on the frequency grid. Further keyword arguments are ignored.
+
+        Returns:
+        - Prepared: Pass to evaluate
+        '''
+        missing = [ name for name in self.params if name not in params ]
+        if missing:
+            raise ValueError(f"Missing network parameters: {', '.join(missing)}")
+        return Prepared(self, self.prepare_values(np.asarray(frequencies), params))
+
+    def evaluate(self, prepared, **loads):
+        '''
+        Returns:
+        - dict: Output name -> np.ndarray, broadcast over the loads
+        '''
+        missing = [ name for name in self.loads if name not in loads ]
+        if missing:
+            raise ValueError(f"Missing network loads: {', '.join(missing)}")
+        return self.evaluate_values(prepared.values, loads)
+
+    def __call__(self, frequencies, **values):
+        return self.evaluate(self.prepare(frequencies, **values), **{ name: values[name] for name in self.loads if name in values })
+
+def compile_network(outputs):
+    '''
+    Compiles a network description
+
+    Parameters:
+    - outputs (dict): Output name -> expression (e.g. transfer_function or input_impedance of two-ports)
+
+    Returns:
+    - CompiledNetwork
+    '''
+    return CompiledNetwork({ name: wrap(node) for name, node in outputs.items() })
+
+def evaluate(prepared, **loads):
+    '''
+    Evaluates a prepared network (see CompiledNetwork.prepare) for the given loads
+    '''
+    return prepared.network.evaluate(prepared, **loads)
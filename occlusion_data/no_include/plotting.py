@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+
+## Fast plotting backend
+# Draws all curves of a campaign as one LineCollection and every mean/std band as one PolyCollection (fill_between)
+# instead of one pyfar line per curve. Magnitudes are converted to dB once by the caller (db) and may be decimated
+# for display (decimate): the frequency axis is split into log-spaced bins and only the minimum and maximum of every
+# curve per bin are kept, which preserves peaks and notches at a fraction of the points.
+# Without a display the figures are rendered with Agg (PNG) or the PDF backend directly, pyplot is not used.
+
+def db(data):
+    '''
+    20*log10(|data|), zeros become -inf without warnings
+    '''
+    with np.errstate(divide='ignore'):
+        return 20*np.log10(np.abs(data))
+
+def log_bins(frequencies, points_per_decade):
+    '''
+    Index edges of log-spaced frequency bins with points_per_decade bins per decade
+    '''
+    f_lo = max(frequencies[0], np.finfo(float).tiny)
+    n_bins = max(1, int(np.ceil(np.log10(frequencies[-1] / f_lo) * points_per_decade)))
+    edges = np.searchsorted(frequencies, np.geomspace(f_lo, frequencies[-1], n_bins + 1)[1:-1])
+    return np.unique(np.concatenate(([0], edges, [len(frequencies)])))
+
+def decimate(frequencies, values, points_per_decade = None):
+    '''
+    Min/max decimation of curves on a log frequency axis
+
+    Parameters:
+    - frequencies (np.ndarray): Ascending frequency vector (n_freqs,)
+    - values (np.ndarray): Curves (n_curves, n_freqs), e.g. in dB
+    - points_per_decade (int): Bins per decade, None keeps all points
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequencies and values, both (n_curves, n_points)
+    '''
+    values = np.atleast_2d(values)
+    if points_per_decade is None or values.shape[1] <= 2*points_per_decade:
+        return np.broadcast_to(frequencies, values.shape), values
+
+    edges = log_bins(frequencies, points_per_decade)
+    if 2*(len(edges) - 1) >= values.shape[1]:
+        return np.broadcast_to(frequencies, values.shape), values
+
+    filled = np.where(np.isnan(values), -np.inf, values)
+    index = np.empty((values.shape[0], 2*(len(edges) - 1)), dtype=np.intp)
+    for i, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+        lo = np.argmin(filled[:, start:end], axis=1) + start
+        hi = np.argmax(filled[:, start:end], axis=1) + start
+        index[:, 2*i] = np.minimum(lo, hi)
+        index[:, 2*i + 1] = np.maximum(lo, hi)
+
+    return frequencies[index], np.take_along_axis(values, index, axis=1)
+
+def add_curves(ax, frequencies, values_db, decimation = None, **kwargs):
+    '''
+    Adds curves (n_curves, n_freqs) in dB as one LineCollection. kwargs are passed to LineCollection
+    (color, linestyle, linewidth, alpha, label); color and linestyle may be lists with one entry per curve.
+    '''
+    from matplotlib.collections import LineCollection
+
+    x, y = decimate(frequencies, values_db, decimation)
+    collection = LineCollection(np.stack([x, y], axis=-1), **kwargs)
+    ax.add_collection(collection)
+    return collection
+
+def add_band(ax, frequencies, lower_db, upper_db, decimation = None, **kwargs):
+    '''
+    Adds a band between two curves in dB as one PolyCollection. With decimation the band is the envelope
+    (minimum of lower_db, maximum of upper_db) over every log-spaced bin, placed at the bin centers.
+    '''
+    if decimation is not None and len(frequencies) > 2*decimation:
+        edges = log_bins(frequencies, decimation)
+        x = np.sqrt(frequencies[edges[:-1]] * frequencies[edges[1:] - 1])
+        lower_db = np.minimum.reduceat(lower_db, edges[:-1])
+        upper_db = np.maximum.reduceat(upper_db, edges[:-1])
+    else:
+        x = frequencies
+    return ax.fill_between(x, lower_db, upper_db, **kwargs)
+
+def new_figure(num, show):
+    '''
+    Creates figure num through pyplot if it is shown, otherwise as a plain Figure (rendered with Agg/PDF on save)
+    '''
+    if show:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(num)
+    else:
+        from matplotlib.figure import Figure
+        fig = Figure()
+    return fig, fig.add_subplot()
+
+def format_axes(ax, frequencies, title, ylim, loc_legend, handles = None):
+    '''
+    Log frequency axis, labels and grid as pf.plot.freq, ylim and legend position as in figures.json
+    '''
+    from matplotlib.ticker import FuncFormatter, LogLocator, NullFormatter
+
+    ax.set_title(title)
+    ax.set_xscale('log')
+    ax.set_xlim(frequencies[0], frequencies[-1])
+    ax.set_ylim(ylim[0], ylim[1])
+    ax.xaxis.set_major_locator(LogLocator(subs=(1, 2, 4, 6)))
+    ax.xaxis.set_major_formatter(FuncFormatter(lambda x, _: f'{x/1000:g}k' if x >= 1000 else f'{x:g}'))
+    ax.xaxis.set_minor_formatter(NullFormatter())
+    ax.grid(True, 'both')
+    ax.set_xlabel('Frequency in Hz')
+    ax.set_ylabel('Magnitude in dB')
+
+    legend = {} if handles is None else {'handles': handles}
+    if loc_legend == 'inner':
+        ax.legend(loc='lower right', **legend)
+    elif loc_legend == 'outer':
+        ax.legend(bbox_to_anchor=(1.05, 1.03), loc = 'upper left', **legend)
+
+def save_figure(fig, output_dir, num, fmt = 'png'):
+    os.makedirs(output_dir, exist_ok=True)
+    fig.savefig(os.path.join(output_dir, f'fig{num}.{fmt}'), bbox_inches='tight')
+    print(f'Saved: fig{num}.{fmt}')
@@ -0,0 +1,396 @@
+import io
+import os
+import mmap
+import re
+import csv
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import cache
+import resample
+import instrument
+
+# Regular expression to extract the real part from the frequency column
+# This assumes the frequency column is always in the form 'number+0i' or 'number-0i'
+freq_pattern = re.compile(r'^([-+]?\d*\.?\d+)(?:[+-]0i)$', re.IGNORECASE)
+# The same pattern applied to the first column of every line of a text at once (see parse_frequency_text)
+freq_column_pattern = re.compile(r'^[ \t]*[-+]?\d*\.?\d+[+-]0i[ \t]*,', re.IGNORECASE | re.MULTILINE)
+
+def count_file(n_rows, n_bytes):
+    '''
+    Counts one parsed file. Only the outermost read_* entry point counts, parse_* helpers and fallbacks do not.
+    '''
+    instrument.count('files_parsed')
+    instrument.count('rows_parsed', n_rows)
+    instrument.count('bytes_read', n_bytes)
+
+def read_frequency_rows(file_path):
+    """
+    Reads a CSV file row by row, see parse_frequency_rows
+
+    Parameters:
+    - file_path (str): Path to the CSV file.
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector (float64) and data (complex128)
+    """
+    freqVec, freqDat = parse_frequency_rows(file_path)
+    count_file(len(freqVec), os.path.getsize(file_path))
+    return freqVec, freqDat
+
+def parse_frequency_rows(file_path):
+    """
+    Parses a CSV file row by row. This is the strict reference parser: it handles every
+    format the bulk reader rejects (quoted fields, whitespace, dB values) and raises
+    with the row number of the first malformed row.
+
+    Parameters:
+    - file_path (str): Path to the CSV file.
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector (float64) and data (complex128)
+    """
+    freqVec = []
+    freqDat = []
+    db_row = None
+
+    # Open and read the CSV file
+    with open(file_path, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        for row_num, row in enumerate(reader, start=1):
+            if len(row) != 2:
+                raise ValueError(f"Row {row_num} does not have exactly two columns: {row}")
+
+            # Process the frequency column
+            freq_str = row[0].strip()
+            freq_match = freq_pattern.match(freq_str)
+            if not freq_match:
+                raise ValueError(f"Invalid frequency format in row {row_num}: '{freq_str}'")
+            freq_real = float(freq_match.group(1))
+            freqVec.append(freq_real)
+
+            # Process the measurement column
+            dat_str = row[1].strip()
+            # Replace 'i' with 'j' for Python complex numbers
+            dat_str_python = dat_str.replace('i', 'j')
+            if 'j' in dat_str_python:
+                try:
+                    dat_complex = complex(dat_str_python)
+                except ValueError as e:
+                    raise ValueError(f"Cannot parse into complex number {row_num}: '{dat_str}'") from e
+                freqDat.append(dat_complex)
+            else:
+                if db_row is None:
+                    db_row = row_num
+                    print(f'Cannot interpret data as complex (first in row {row_num}), interpreting as dB values instead...')
+                try:
+                    dat_complex = 10 ** (float(dat_str) / 20)
+                except ValueError as e:
+                    raise ValueError(f"Cannot parse into dB value {row_num}: '{dat_str}'") from e
+                dat_complex = complex(dat_complex, 0)
+                freqDat.append(dat_complex)
+
+    # Convert lists to NumPy arrays for better performance and usability
+    freqVec = np.array(freqVec, dtype=np.float64)
+    freqDat = np.array(freqDat, dtype=np.complex128)
+
+    return freqVec, freqDat
+
+def parse_frequency_text(text):
+    '''
+    Parses well-formed MATLAB output ('a+bi' in both columns) in bulk.
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector and data, None if the text needs the row-wise parser
+    '''
+    if '\r' in text:
+        text = text.replace('\r\n', '\n')
+
+    n_rows = text.count('\n') + (not text.endswith('\n'))
+
+    # Every valid row holds exactly two 'i': the '+0i' of the frequency and the imaginary unit of the data.
+    # Blank lines, dB values or extra columns break this count and are left to the row-wise parser.
+    if not text or text.count('i') != 2 * n_rows:
+        return None
+
+    try:
+        raw = np.loadtxt(io.StringIO(text.replace('i', 'j')), delimiter=',', dtype=np.complex128, comments=None, ndmin=2)
+    except ValueError:
+        return None
+
+    if raw.shape != (n_rows, 2) or np.any(raw[:, 0].imag != 0):
+        return None
+
+    # NumPy also accepts frequencies the row-wise parser rejects ('1e2+0i', '100+0.0i'), leave those to it
+    if sum(1 for _ in freq_column_pattern.finditer(text)) != n_rows:
+        return None
+
+    freqVec = np.ascontiguousarray(raw[:, 0].real)
+    freqDat = np.ascontiguousarray(raw[:, 1])
+
+    return freqVec, freqDat
+
+def read_frequency_arrays(file_path):
+    """
+    Reads a CSV file containing a freqency vector and corresponding complex measurement data, see parse_frequency_file
+
+    Parameters:
+    - file_path (str): Path to the CSV file.
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector (float64) and data (complex128)
+    """
+    freqVec, freqDat = parse_frequency_file(file_path)
+    count_file(len(freqVec), os.path.getsize(file_path))
+    return freqVec, freqDat
+
+def parse_frequency_file(file_path):
+    """
+    Parses a CSV file in one pass. Well-formed MATLAB output ('a+bi' in both columns) is parsed in bulk by NumPy.
+    Anything else falls back to parse_frequency_rows, which applies the full row-wise validation
+    and reports the first bad row.
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector (float64) and data (complex128)
+    """
+    with open(file_path, 'r') as csvfile:
+        text = csvfile.read()
+
+    parsed = parse_frequency_text(text)
+    if parsed is None:
+        return parse_frequency_rows(file_path)
+
+    return parsed
+
+def row_frequency(mm, start):
+    '''
+    Returns the frequency of the row starting at byte offset start, None if it cannot be parsed
+    '''
+    end = mm.find(b',', start)
+    if end < 0:
+        return None
+    freq_match = freq_pattern.match(mm[start:end].decode('ascii', 'replace').strip())
+    if not freq_match:
+        return None
+    return float(freq_match.group(1))
+
+def last_row(mm):
+    '''
+    Returns the byte offset of the last non-empty row of a file
+    '''
+    end = len(mm)
+    while end > 0 and mm[end-1:end] in (b'\n', b'\r', b' ', b'\t'):
+        end -= 1
+    return mm.rfind(b'\n', 0, end) + 1
+
+def seek_frequency(mm, value, right = False):
+    '''
+    Bisects the byte offsets of a file with ascending frequencies (see read_frequency_range for the check) and returns
+    the offset of the first row with a frequency >= value (> value if right is set). Only the rows touched by the
+    bisection are parsed.
+    '''
+    def row_start(pos):
+        if pos == 0:
+            return 0
+        newline = mm.find(b'\n', pos - 1)
+        return len(mm) if newline < 0 else newline + 1
+
+    lo, hi = 0, len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = row_start(mid)
+        if start >= len(mm):
+            hi = mid
+            continue
+        freq = row_frequency(mm, start)
+        if freq is None:
+            raise ValueError(f'Cannot read frequency at byte {start}')
+        if freq > value or (freq == value and not right):
+            hi = mid
+        else:
+            lo = mid + 1
+    return row_start(lo)
+
+def read_frequency_range(file_path, freq_range):
+    '''
+    Reads only the rows of a CSV file that lie within freq_range. The file is memory mapped, the band is located
+    by bisection over the row offsets and only the rows inside the band are parsed. Bisection needs ascending
+    frequencies (as in all measurement exports): files whose first and last row are not ascending, or whose band
+    is out of order or out of range, are read in full and cropped afterwards.
+    Rows outside the band are not validated, a malformed row there only raises when the file is read in full
+    (read_frequency_arrays). Counted as one file with the bytes and rows of the band, or of the whole file if it
+    was read in full.
+
+    Parameters:
+    - file_path (str): Path to the CSV file.
+    - freq_range ([float, float]): Lower and upper frequency in Hz
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector (float64) and data (complex128) within freq_range
+    '''
+    parsed = None
+    try:
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            first, last = row_frequency(mm, 0), row_frequency(mm, last_row(mm))
+            if first is None or last is None or first > last:
+                raise ValueError('Frequencies are not ascending')
+            start = seek_frequency(mm, freq_range[0])
+            end = max(start, seek_frequency(mm, freq_range[1], right = True))
+            if start == end:
+                parsed = (np.array([], dtype=np.float64), np.array([], dtype=np.complex128))
+            else:
+                parsed = parse_frequency_text(mm[start:end].decode('ascii'))
+    except (ValueError, UnicodeDecodeError):
+        parsed = None
+
+    # Band must be ascending and inside the range, otherwise the file does not have the expected layout
+    if parsed is not None:
+        frequenciesNew, freqs = parsed
+        if np.all(np.diff(frequenciesNew) >= 0) and np.all((frequenciesNew >= freq_range[0]) & (frequenciesNew <= freq_range[1])):
+            count_file(len(frequenciesNew), end - start)
+            return frequenciesNew, freqs
+
+    frequenciesRaw, freqsRaw = read_frequency_arrays(file_path)
+
+    mask = (frequenciesRaw >= freq_range[0]) & (frequenciesRaw <= freq_range[1])
+
+    return frequenciesRaw[mask], freqsRaw[mask]
+
+def read_frequency_csv(file_path):
+    """
+    Reads a CSV file containing a freqency vector and corresponding complex measurement data.
+
+    Parameters:
+    - file_path (str): Path to the CSV file.
+
+    Returns:
+    - pf.FrequencyData: The data in Pyfar format
+    """
+    import pyfar as pf
+
+    freqVec, freqDat = read_frequency_arrays(file_path)
+
+    data = pf.FrequencyData(freqDat, freqVec)
+    instrument.count('pyfar_objects')
+
+    return data
+
+def to_grid(file_path, frequenciesNew, freqs, target = None, interp = None):
+    '''
+    Resamples the data of a file onto the target grid if the frequencies differ, see resample.resample
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector and data
+    '''
+    if target is not None and not np.array_equal(target, frequenciesNew):
+        print(f'WARNING: Frequencies of {os.path.basename(file_path)} differ from reference. Interpolating....')
+        freqs = resample.resample(frequenciesNew, freqs, target, interp)
+        frequenciesNew = target
+
+    return frequenciesNew, freqs
+
+def crop_to_grid(file_path, freq_range, target = None, interp = None):
+    '''
+    Reads a CSV file, crops it to freq_range and interpolates it onto the target grid if the
+    frequencies differ.
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector and data
+    '''
+    frequenciesNew, freqs = read_frequency_range(file_path, freq_range)
+
+    return to_grid(file_path, frequenciesNew, freqs, target, interp)
+
+@instrument.timed
+def read_cropped(file_path, freq_range, target = None, interp = None):
+    '''
+    Like crop_to_grid, but results are served from the on-disk cache while the file, freq_range,
+    target grid and interpolation mode are unchanged.
+
+    Returns:
+    - (np.ndarray, np.ndarray): Frequency vector and data
+    '''
+    key = cache.cache_key(file_path, freq_range, target, interp or resample.mode)
+    cached = cache.load(key)
+    if cached is not None:
+        return cached
+
+    frequenciesNew, freqs = crop_to_grid(file_path, freq_range, target, interp)
+
+    cache.store(key, frequenciesNew, freqs)
+
+    return frequenciesNew, freqs
+
+def lookup_cached(file_path, freq_range, target, interp):
+    '''
+    Thread pool task: returns (key, cached arrays or None) or the exception raised for the file
+    '''
+    try:
+        key = cache.cache_key(file_path, freq_range, target, interp)
+        return key, cache.load(key)
+    except Exception as e:
+        return e
+
+def try_read_range(args):
+    '''
+    Process pool task: returns the result of read_frequency_range or the exception raised for the file,
+    together with the instrumentation counters of the task
+    '''
+    with instrument.collect() as collected:
+        try:
+            result = read_frequency_range(*args)
+        except Exception as e:
+            result = e
+    return result, collected
+
+@instrument.timed
+def read_cropped_many(file_paths, freq_range, target = None, workers = None, interp = None):
+    '''
+    Reads many CSV files concurrently. Cache lookups (I/O bound) run on a thread pool, files that
+    have to be parsed are distributed over a process pool. Resampling onto target happens in the
+    calling process, so files on the same grid share one interpolation table. Errors are isolated per file.
+
+    Parameters:
+    - file_paths (list of str): Paths to the CSV files
+    - freq_range ([float, float]): Lower and upper frequency in Hz
+    - target (np.ndarray): Frequency grid to interpolate onto, None to keep the file's grid
+    - workers (int): Number of threads/processes, None uses all cores, 1 reads sequentially
+    - interp (str): Interpolation mode, see resample.apply_table (None: resample.mode)
+
+    Returns:
+    - list: One entry per file in the order of file_paths, either (frequencies, data) or the Exception raised
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    interp = interp or resample.mode
+
+    if workers > 1 and len(file_paths) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            lookups = list(pool.map(lookup_cached, file_paths, [freq_range]*len(file_paths), [target]*len(file_paths), [interp]*len(file_paths)))
+    else:
+        lookups = [ lookup_cached(file_path, freq_range, target, interp) for file_path in file_paths ]
+
+    results = [ lookup if isinstance(lookup, Exception) else lookup[1] for lookup in lookups ]
+    misses = [ i for i, lookup in enumerate(lookups) if not isinstance(lookup, Exception) and lookup[1] is None ]
+    tasks = [ (file_paths[i], freq_range) for i in misses ]
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            parsed = list(pool.map(try_read_range, tasks))
+    else:
+        parsed = [ try_read_range(task) for task in tasks ]
+
+    for i, (result, collected) in zip(misses, parsed):
+        instrument.merge(collected)
+        if not isinstance(result, Exception):
+            try:
+                result = to_grid(file_paths[i], *result, target, interp)
+            except Exception as e:
+                result = e
+        results[i] = result
+        if not isinstance(result, Exception):
+            cache.store(lookups[i][0], *result)
+
+    return results
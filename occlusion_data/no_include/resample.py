@@ -0,0 +1,98 @@
+import time
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+import cache
+
+## Resampling onto the reference grid
+# Linear interpolation is split into a table (left index and weight per target frequency) and its application.
+# Tables depend only on the source and target grid and are kept per distinct pair, so all files of a campaign
+# exported on the same grid share one search. Outside the source grid the edge values are held, as in np.interp.
+# Modes:
+# - 'realimag': real and imaginary part are interpolated (matches np.interp on complex data to rounding, ~1e-15, as the weights are precomputed)
+# - 'magphase': magnitude and unwrapped phase are interpolated, which keeps the magnitude of resonances
+mode = 'realimag'
+table_maxsize = 32
+
+stats = {'files': 0, 'tables': 0, 'table_hits': 0, 'seconds': 0.0}
+
+InterpTable = namedtuple('InterpTable', ['index', 'weight'])
+
+tables = OrderedDict()
+
+def interp_table(source, target):
+    '''
+    Index and weight table for linear interpolation from the ascending grid source onto target
+
+    Returns:
+    - InterpTable: value = data[index] * (1 - weight) + data[index + 1] * weight
+    '''
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    if source.size == 0:
+        raise ValueError('Cannot interpolate from an empty frequency grid')
+    if source.size == 1:
+        return InterpTable(np.zeros(target.shape, dtype=np.intp), np.zeros(target.shape))
+
+    index = np.clip(np.searchsorted(source, target, side='right') - 1, 0, source.size - 2)
+    step = source[index + 1] - source[index]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(step > 0, (target - source[index]) / step, 0)
+
+    return InterpTable(index, np.clip(weight, 0, 1))
+
+def get_table(source, target):
+    '''
+    Returns the (cached) interpolation table for a pair of grids
+    '''
+    key = (cache.grid_digest(source), cache.grid_digest(target))
+    if key in tables:
+        tables.move_to_end(key)
+        stats['table_hits'] += 1
+        return tables[key]
+
+    table = interp_table(source, target)
+    tables[key] = table
+    stats['tables'] += 1
+    while len(tables) > table_maxsize:
+        tables.popitem(last=False)
+    return table
+
+def apply_table(table, data, interp = None):
+    '''
+    Interpolates data (..., n_source) with a table along the last axis
+    '''
+    interp = interp or mode
+    data = np.asarray(data)
+    upper = np.minimum(table.index + 1, data.shape[-1] - 1)
+
+    def linear(values):
+        return values[..., table.index] * (1 - table.weight) + values[..., upper] * table.weight
+
+    if interp == 'realimag':
+        return linear(data)
+    if interp == 'magphase':
+        return linear(np.abs(data)) * np.exp(1j*linear(np.unwrap(np.angle(data))))
+    raise ValueError(f"Unknown interpolation mode '{interp}', use 'realimag' or 'magphase'")
+
+def resample(source, data, target, interp = None):
+    '''
+    Resamples data given on the grid source onto target
+
+    Parameters:
+    - source (np.ndarray): Ascending frequency grid of data
+    - data (np.ndarray): Data, shape (..., len(source))
+    - target (np.ndarray): Frequency grid to interpolate onto
+    - interp (str): 'realimag' or 'magphase', None uses mode
+
+    Returns:
+    - np.ndarray: Data on target, shape (..., len(target))
+    '''
+    start = time.perf_counter()
+
+    data = apply_table(get_table(source, target), data, interp)
+
+    stats['files'] += 1
+    stats['seconds'] += time.perf_counter() - start
+    return data
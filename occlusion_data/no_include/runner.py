@@ -0,0 +1,280 @@
+import os
+import sys
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import model
+import resample
+import instrument
+from readers import read_cropped, read_cropped_many
+import sim
+
+## Campaign runner
+# Evaluates every combination of reference x campaign x freq_range and writes one result table (CSV) with a row per
+# measurement and one per campaign mean. Every file is parsed once in this process, over the union of all frequency
+# ranges (through the cache), and packed into two shared memory blocks (frequencies and data). The workers attach to
+# the blocks once, crop and resample views of them per combination like sim.py does and only send back table rows.
+#
+#   python occlusion_data/no_include/runner.py --freq-range 100 1500 --freq-range 200 1000 --output runs.csv
+columns = ['reference', 'campaign', 'f_min', 'f_max', 'measurement', 'n_freqs', 'effect_mean_db', 'effect_max_db', 'f_at_max', 'effect_min_db', 'f_at_min']
+
+# Attached blocks and views per file of a worker, see attach
+shared = {}
+
+def list_references(ref_folder):
+    '''
+    All reference CSVs in ref_folder and its no_include subfolder, relative to ref_folder
+    '''
+    files = []
+    for folder in (ref_folder, os.path.join(ref_folder, 'no_include')):
+        if os.path.isdir(folder):
+            files += sorted( os.path.relpath(os.path.join(folder, file), ref_folder) for file in os.listdir(folder) if file.endswith('.csv') )
+    return files
+
+def list_campaigns(measurements_folder):
+    '''
+    Measurement CSVs per campaign (subfolder), no_include is skipped as in sim.read_measurements
+
+    Returns:
+    - dict: campaign -> sorted list of file paths
+    '''
+    campaigns = {}
+    for subfolder in sorted(os.listdir(measurements_folder)):
+        subfolder_path = os.path.join(measurements_folder, subfolder)
+        if not os.path.isdir(subfolder_path) or subfolder == 'no_include':
+            continue
+        campaigns[subfolder] = sorted( os.path.join(subfolder_path, file) for file in os.listdir(subfolder_path) if file.endswith('.csv') )
+    return campaigns
+
+@instrument.timed
+def share(parsed):
+    '''
+    Copies parsed files into two shared memory blocks
+
+    Parameters:
+    - parsed (dict): file path -> (frequencies, data)
+
+    Returns:
+    - (list, dict): The blocks (close and unlink them when done) and the layout for attach:
+      block names, total length and the (start, stop) slice of every file
+    '''
+    offsets = {}
+    n = 0
+    for file_path, (frequencies, _) in parsed.items():
+        offsets[file_path] = (n, n + len(frequencies))
+        n += len(frequencies)
+
+    blocks = [ shared_memory.SharedMemory(create=True, size=max(1, n*np.dtype(dtype).itemsize)) for dtype in (np.float64, np.complex128) ]
+    frequencies = np.ndarray((n,), dtype=np.float64, buffer=blocks[0].buf)
+    data = np.ndarray((n,), dtype=np.complex128, buffer=blocks[1].buf)
+    for file_path, (start, stop) in offsets.items():
+        frequencies[start:stop], data[start:stop] = parsed[file_path]
+
+    return blocks, {'names': [ block.name for block in blocks ], 'size': n, 'offsets': offsets}
+
+def attach(layout, params, interp):
+    '''
+    Worker initializer: maps the shared blocks and sets the EC network, its parameters and the interpolation mode
+    '''
+    blocks = [ shared_memory.SharedMemory(name=name) for name in layout['names'] ]
+    frequencies = np.ndarray((layout['size'],), dtype=np.float64, buffer=blocks[0].buf)
+    data = np.ndarray((layout['size'],), dtype=np.complex128, buffer=blocks[1].buf)
+
+    shared['blocks'] = blocks
+    shared['files'] = { file_path: (frequencies[start:stop], data[start:stop]) for file_path, (start, stop) in layout['offsets'].items() }
+    shared['params'] = params
+    resample.mode = interp
+
+def crop(file_path, freq_range):
+    frequencies, data = shared['files'][file_path]
+    mask = (frequencies >= freq_range[0]) & (frequencies <= freq_range[1])
+    return frequencies[mask], data[mask]
+
+def effect_row(label, frequencies, effect_db):
+    i_max, i_min = np.argmax(effect_db), np.argmin(effect_db)
+    return {
+        'measurement': label,
+        'n_freqs': len(frequencies),
+        'effect_mean_db': float(np.mean(effect_db)),
+        'effect_max_db': float(effect_db[i_max]),
+        'f_at_max': float(frequencies[i_max]),
+        'effect_min_db': float(effect_db[i_min]),
+        'f_at_min': float(frequencies[i_min]),
+    }
+
+def evaluate(combination):
+    '''
+    Process pool task: occlusion effect T / T_ref of all measurements of a campaign for one reference and freq_range
+
+    Parameters:
+    - combination ((str, str, str, list, (float, float))): Reference label and path, campaign, measurement paths, freq_range
+
+    Returns:
+    - (list, list): Table rows (see columns) and (file path, Exception) of every file that could not be evaluated,
+      errors are isolated per file like in read_cropped_many
+    '''
+    reference, reference_path, campaign, file_paths, freq_range = combination
+    try:
+        return evaluate_files(reference, reference_path, campaign, file_paths, freq_range)
+    except Exception as e:
+        return [], [(reference_path, e)]
+
+def evaluate_files(reference, reference_path, campaign, file_paths, freq_range):
+    p = shared['params']
+
+    frequencies, Z_ref = crop(reference_path, freq_range)
+    common = {'reference': reference, 'campaign': campaign, 'f_min': freq_range[0], 'f_max': freq_range[1]}
+    if len(frequencies) == 0:
+        return [], []
+
+    terms = model.prepare_network(p['network'], frequencies, **p['ear'])
+    T_ref = model.transfer_functions( Z_ref / p['ear']['S_ec'], terms )
+
+    Z = np.empty((len(file_paths), len(frequencies)), dtype=np.complex128)
+    evaluated, errors = [], []
+    for file_path in file_paths:
+        try:
+            source, data = crop(file_path, freq_range)
+            Z[len(evaluated)] = data if np.array_equal(source, frequencies) else resample.resample(source, data, frequencies)
+            evaluated.append(file_path)
+        except Exception as e:
+            errors.append((file_path, e))
+    file_paths = evaluated
+    T = model.transfer_functions( Z[:len(file_paths)] / p['ear']['S_ec'], terms )
+
+    rows = [ common | effect_row(os.path.splitext(os.path.basename(file_path))[0], frequencies, 20*np.log10(np.abs(T[i] / T_ref))) for i, file_path in enumerate(file_paths) ]
+    if len(file_paths):
+        rows.append( common | effect_row('mean', frequencies, 20*np.log10(np.abs(T).mean(axis=0) / np.abs(T_ref))) )
+    return rows, errors
+
+@instrument.timed
+def read_all(references, campaigns, freq_ranges, workers = None):
+    '''
+    Parses all reference and measurement files over the union of the frequency ranges
+
+    Returns:
+    - dict: file path -> (frequencies, data), files that could not be read are left out
+    '''
+    union = [min(freq_range[0] for freq_range in freq_ranges), max(freq_range[1] for freq_range in freq_ranges)]
+
+    parsed = {}
+    for reference_path in references:
+        try:
+            parsed[reference_path] = read_cropped(reference_path, union)
+        except Exception as e:
+            print(f"ERROR: Couldn't read {reference_path} as FrequencyData")
+            print(e)
+
+    file_paths = [ file_path for paths in campaigns.values() for file_path in paths ]
+    for file_path, result in zip(file_paths, read_cropped_many(file_paths, union, workers = workers)):
+        if isinstance(result, Exception):
+            print(f"ERROR: Couldn't read {file_path} as FrequencyData")
+            print(result)
+            continue
+        parsed[file_path] = result
+        print(f'Processed: {os.path.basename(file_path)}')
+    return parsed
+
+@instrument.timed
+def run_matrix(references, campaigns, freq_ranges, workers = None, interp = 'realimag'):
+    '''
+    Evaluates all combinations of references, campaigns and frequency ranges
+
+    Parameters:
+    - references (dict): Reference label -> file path
+    - campaigns (dict): Campaign -> list of measurement file paths
+    - freq_ranges (list): [f_min, f_max] settings
+    - workers (int): Number of processes, None uses all cores, 1 evaluates in this process
+
+    Returns:
+    - list: Table rows (dicts with columns), ordered by reference, campaign and frequency range
+    '''
+    parsed = read_all(list(references.values()), campaigns, freq_ranges, workers)
+    combinations = [
+        (reference, reference_path, campaign, [ file_path for file_path in file_paths if file_path in parsed ], list(freq_range))
+        for reference, reference_path in references.items() if reference_path in parsed
+        for campaign, file_paths in campaigns.items()
+        for freq_range in freq_ranges
+    ]
+    params = {'network': sim.ear_network, 'ear': sim.ear_parameters()}
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    blocks, layout = share(parsed)
+    try:
+        if workers > 1 and len(combinations) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(combinations)), initializer=attach, initargs=(layout, params, interp)) as pool:
+                results = list(pool.map(evaluate, combinations))
+        else:
+            attach(layout, params, interp)
+            results = [ evaluate(combination) for combination in combinations ]
+    finally:
+        for block in shared.pop('blocks', []):
+            block.close()
+        shared.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    for (reference, _, campaign, _, freq_range), (_, errors) in zip(combinations, results):
+        for file_path, e in errors:
+            print(f"ERROR: Couldn't evaluate {os.path.basename(file_path)} ({reference}, {campaign}, {freq_range[0]:g}-{freq_range[1]:g} Hz)")
+            print(e)
+
+    return [ row for rows, _ in results for row in rows ]
+
+def write_table(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'Saved: {path}')
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description='Evaluates the occlusion effect for every combination of reference, measurement campaign and frequency range.')
+    parser.add_argument('--references', nargs='+', help='Reference files relative to the reference folder (default: all, no_include included)')
+    parser.add_argument('--campaigns', nargs='+', help='Measurement campaigns (default: all)')
+    parser.add_argument('--freq-range', nargs=2, type=float, action='append', metavar=('F_MIN', 'F_MAX'), help=f'Frequency range in Hz, repeat for several (default: {sim.freq_range})')
+    parser.add_argument('--measurements', default=sim.measurements_folder, help='Measurements folder (default: %(default)s)')
+    parser.add_argument('--reference-folder', default=sim.ref_folder, help='Reference folder (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes for parsing and evaluation (default: one per core)')
+    parser.add_argument('--interp', choices=['realimag', 'magphase'], default=resample.mode, help='Interpolation onto the reference grid (default: %(default)s)')
+    parser.add_argument('--output', default='runs.csv', help='Result table (default: %(default)s)')
+    parser.add_argument('--report', help='Writes the run report (stage timings and counters) as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+
+    references = { reference: os.path.join(args.reference_folder, reference) for reference in (args.references or list_references(args.reference_folder)) }
+    campaigns = list_campaigns(args.measurements) if os.path.isdir(args.measurements) else {}
+    if args.campaigns:
+        missing = [ campaign for campaign in args.campaigns if campaign not in campaigns ]
+        if missing:
+            print(f"ERROR: Campaign(s) not found: {', '.join(missing)}")
+            return 1
+        campaigns = { campaign: campaigns[campaign] for campaign in args.campaigns }
+    freq_ranges = args.freq_range or [sim.freq_range]
+
+    if not references or not campaigns:
+        print(f'ERROR: No references or campaigns found')
+        return 1
+
+    instrument.reset()
+    start = time.perf_counter()
+    rows = run_matrix(references, campaigns, freq_ranges, args.workers, args.interp)
+    n_combinations = len({ (row['reference'], row['campaign'], row['f_min'], row['f_max']) for row in rows })
+    print(f'MESSAGE: Evaluated {n_combinations} of {len(references)*len(campaigns)*len(freq_ranges)} combinations in {time.perf_counter() - start:.2f} s')
+
+    write_table(args.output, rows)
+    instrument.report(args.report)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,27 @@
 #%%
 import os
-import re
-import csv
+import sys
 import json
+import time
+import argparse
 
 import numpy as np
-import pyfar as pf
-import matplotlib.pyplot as plt
-import pyabsorp as pa
-import matplotlib.patches as mpatches
 
 from numpy import pi
-
-## Select what to plot:
-# Read figures configuration from figures.json
-with open('figures.json', 'r') as f:
-    figures = json.load(f)
+from readers import read_cropped, read_cropped_many
+
+import cache
+import resample
+import model
+import design
+import export
+import stats
+import store
+import instrument
+import plotting
+import montecarlo
+import modelgrid
+import network
 
 # Constants
 c = 343
@@ -35,195 +41,175 @@ l_u = l_c
 l_d = l_ec-l_c
 S_ec = pi*r_ec**2
 
+# Compiled outer ear network (see model.outer_ear_description), replace to evaluate another topology
+ear_network = model.outer_ear
+
 # Init measurements dict
+# All data is kept as NumPy arrays on the common grid 'frequencies', pyfar objects are only created for plotting
+# Measured impedances live in the memory mapped store (see store.py), measurements[collection][key] are row views
 measurements = {}
+meas_store = {}
+meas_index = []
+T_meas_projects = []
 occl_plots = {}
 Z_ref = None
 freq_range = [100, 1500]
 frequencies = np.array([])
 
-def read_frequency_csv(file_path):
-    """
-    Reads a CSV file containing a freqency vector and corresponding complex measurement data.
+# Data folders and reference file (None: chosen automatically if unique, otherwise prompted for)
+measurements_folder = './measurements'
+ref_folder = './reference'
+occl_plots_folder = './occlusion_data'
+reference = None
+interactive = True
 
-    Parameters:
-    - file_path (str): Path to the CSV file.
+# Parsed file cache: 'use', 'rebuild' (re-parse and overwrite) or 'bypass'
+cache.mode = 'use'
 
-    Returns:
-    - pf.FrequencyData: The data in Pyfar format
-    """
-    freqVec = []
-    freqDat = []
-    
-    # Regular expression to extract the real part from the frequency column
-    # This assumes the frequency column is always in the form 'number+0i' or 'number-0i'
-    freq_pattern = re.compile(r'^([-+]?\d*\.?\d+)(?:[+-]0i)$', re.IGNORECASE)
-    
-    # Open and read the CSV file
-    with open(file_path, 'r', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row_num, row in enumerate(reader, start=1):
-            if len(row) != 2:
-                raise ValueError(f"Row {row_num} does not have exactly two columns: {row}")
-            
-            # Process the frequency column
-            freq_str = row[0].strip()
-            freq_match = freq_pattern.match(freq_str)
-            if not freq_match:
-                raise ValueError(f"Invalid frequency format in row {row_num}: '{freq_str}'")
-            freq_real = float(freq_match.group(1))
-            freqVec.append(freq_real)
-            
-            # Process the measurement column
-            dat_str = row[1].strip()
-            # Replace 'i' with 'j' for Python complex numbers
-            dat_str_python = dat_str.replace('i', 'j')
-            if 'j' in dat_str_python:
-                try:
-                    dat_complex = complex(dat_str_python)
-                except ValueError as e:
-                    raise ValueError(f"Cannot parse into complex number {row_num}: '{dat_str}'") from e
-                freqDat.append(dat_complex)
-            else:
-                print(f'Cannot interpret data as complex, interpreting as dB values instead...')
-                dat_complex = 10 ** (float(dat_str) / 20)
-                dat_complex = complex(dat_complex, 0)
-                freqDat.append(dat_complex)
-    
-    # Convert lists to NumPy arrays for better performance and usability
-    freqVec = np.array(freqVec, dtype=np.float64)
-    freqDat = np.array(freqDat, dtype=np.complex128)
-
-    data = pf.FrequencyData(freqDat, freqVec)
-    
-    return data
-
-def eardrum_impedance(frequencies):
-    # after Shaw & Stinson (1983)
-    # parameters given in Fig. 7 in Schroeter & Pösselt (1986)
-    # Implementation taken from Kersten et. al (2024), DOI: 10.1121/10.0024244
-    omega = 2*np.pi*frequencies
-    iomega = 1j*omega
-    K = 9
-    L_a = 2e3
-    R_a = 1e6
-    C_p = 5.1e-11
-    C_t = 3.5e-12
-    R_m = 2e7
-    C_do = 2e-12
-    R_do = 1.7e7
-    L_d = 1.2e3
-    C_d = 3e-11
-    R_d = 1e6
-    L_o = 3e5
-    C_o = 1.5e-13
-    R_o = 9e8
-    C_s = 2.7e-14
-    R_s = 3e10
-    L_c = 2e5
-    C_c = 5e-14
-    R_c = 6e9
-    
-    # calculations
-    Z_ap = 1/(iomega*C_p) + iomega*L_a + R_a
-    Z_cav = 1/(1/Z_ap + iomega*C_t + 1/R_m)
-    Z_do = R_do + 1/(iomega*C_do)
-    Z_d = R_d + iomega*L_d + 1/(iomega*C_d)
-    Z_s = R_s + 1/(iomega*C_s)
-    Z_c = R_c + iomega*L_c + 1/(iomega*C_c)
-    Z_sc = 1/(1/Z_s + 1/Z_c)
-    Z_o = R_o + iomega*L_o + 1/(iomega*C_o) + Z_sc
-    Z_K = (Z_o*Z_do + Z_o*Z_d + K*K*Z_do*Z_d)/(Z_o+Z_d+(1+K)**2*Z_do)
-    Z_eardrum = Z_cav + Z_K
-    return pf.FrequencyData(Z_eardrum, frequencies)
-
-## Acoustic Transmission line (pressure, volume velocity) for given length, crossectional area, and medium impedance
-def acoustic_transmission_line(k, length, Area, frequencies, Z_eq = Z0):
-    A = np.cos(k*length)
-    B = 1j*(Z_eq/Area)*np.sin(k*length)
-    C = 1j/(Z_eq/Area)*np.sin(k*length)
-    D = np.cos(k*length)
-
-    return pf.TransmissionMatrix.from_abcd(A, B, C, D, frequencies)
+# Parallel file readers (None: one per core)
+workers = None
+
+# Interpolation onto the reference grid: 'realimag' or 'magphase' (see resample.py)
+resample.mode = 'realimag'
+
+# Grid of the pure simulations (perfect occlusion, boxes, fit): 'measurement', 'log' or 'adaptive' (see modelgrid.py)
+modelgrid.mode = 'measurement'
 
+def read_config(file_path):
+    '''
+    Reads the config.json of a collection, None if it cannot be read
+    '''
+    try:
+        with open(file_path, 'r') as conf_raw:
+            return json.load(conf_raw)
+    except Exception as e:
+        print(f'Error reading config')
+        return None
+
+def read_into_store(csv_files, campaigns, reuse = None):
+    '''
+    Reads CSV files block-wise into the stores of their campaigns, only store.chunk files are held in memory at a time.
+    Rows are written in the order of csv_files.
+
+    Parameters:
+    - csv_files (list): (subfolder, file, file_path) of every file
+    - campaigns (dict): Open store per subfolder, see store.create_campaign
+    - reuse (dict): file -> impedance row that is copied instead of reading the file (unchanged files of one campaign in watch mode)
+    '''
+    reuse = reuse or {}
+    for start in range(0, len(csv_files), store.chunk):
+        block = csv_files[start:start + store.chunk]
+        read = [ file_path for (_, file, file_path) in block if file not in reuse ]
+        results = iter(read_cropped_many(read, freq_range, target = frequencies, workers = workers))
+
+        for (subfolder, file, _) in block:
+            if file in reuse:
+                store.add_row(campaigns[subfolder], os.path.splitext(file)[0], reuse[file])
+                continue
+            result = next(results)
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                frequenciesNew, freqs = result
+
+                key = os.path.splitext(file)[0]
+                store.add_row(campaigns[subfolder], key, freqs / S_ec)
+
+                print(f"Processed: {file}")
+            except Exception as e:
+                print(f"ERROR: Couldn't read {file} as FrequencyData")
+                print(e)
+
+@instrument.timed
 def read_measurements():
     '''
     This function reads all impedance measurements in the 'measurements' folder.
     - Each subfolder represents one measurement campaign
     '''
-    global measurements, freq_range, S_ec, frequencies
+    global measurements, meas_store, freq_range, S_ec, frequencies, workers
 
-    measurements_folder = './measurements'
     if not os.path.exists(measurements_folder):
         print(f'ERROR: Measurements folder not found')
         return
-    
+
+    # Stores of a previous read are overwritten, close them first
+    for subfolder in list(meas_store):
+        release_campaign(subfolder)
+
+    csv_files = []
     for subfolder in os.listdir(measurements_folder):
         subfolder_path = os.path.join(measurements_folder, subfolder)
-        
+
         if not os.path.isdir(subfolder_path) or subfolder == 'no_include':
             continue
-        
+
         measurements[subfolder] = {}
-            
-        for file in os.listdir(subfolder_path):
+
+        for file in sorted(os.listdir(subfolder_path)):
             file_path = os.path.join(subfolder_path, file)
             if file == 'config.json':
-                try:
-                    with open(file_path, 'r') as conf_raw:
-                        conf = json.load(conf_raw)
-                        measurements[subfolder]['conf'] = conf
-                except Exception as e:
-                    print(f'Error reading config')
+                conf = read_config(file_path)
+                if conf is not None:
+                    measurements[subfolder]['conf'] = conf
             if file.endswith('.csv'):
-                try:
-                    freqObjRaw = read_frequency_csv(file_path = file_path)
-
-                    frequenciesRaw = freqObjRaw.frequencies
-                    freqsRaw = freqObjRaw.freq[0]
-
-                    mask = (frequenciesRaw >= freq_range[0]) & (frequenciesRaw <= freq_range[1])
+                csv_files.append((subfolder, file, file_path))
 
-                    frequenciesNew = frequenciesRaw[mask]
-                    freqs = freqsRaw[mask]
+    # One store per campaign
+    campaigns = {}
+    for (subfolder, _, _) in csv_files:
+        campaigns[subfolder] = campaigns.get(subfolder, 0) + 1
+    campaigns = { subfolder: store.create_campaign(subfolder, frequencies, n_rows) for subfolder, n_rows in campaigns.items() }
 
-                    if not np.array_equal(frequencies, frequenciesNew):
-                        print(f'WARNING: Frequencies of {file} differ from reference. Interpolating....')
-                        freqs = np.interp(frequencies, frequenciesNew, freqs)
-                        frequenciesNew = frequencies
+    read_into_store(csv_files, campaigns)
 
+    meas_store = { subfolder: store.finish(campaign) for subfolder, campaign in campaigns.items() }
+    for subfolder, campaign in meas_store.items():
+        for row, key in enumerate(campaign.labels):
+            measurements[subfolder][key] = campaign.arrays['Z'][row]
 
-                    freq_data = pf.FrequencyData(freqs / S_ec, frequencies = frequenciesNew)
-
-                    key = os.path.splitext(file)[0]
-                    measurements[subfolder][key] = freq_data
+def release_campaign(subfolder):
+    '''
+    Drops the references to the maps of a campaign (measurement rows, transfer function views) and closes them,
+    so its store can be overwritten, replaced or removed
+    '''
+    global T_meas_projects
 
-                    print(f"Processed: {file}")
-                except Exception as e:
-                    print(f"ERROR: Couldn't read {file} as FrequencyData")
-                    print(e)
+    campaign = meas_store.pop(subfolder, None)
+    if subfolder in measurements:
+        measurements[subfolder] = { key: value for key, value in measurements[subfolder].items() if key == 'conf' }
+    T_meas_projects = [ entry for entry in T_meas_projects if entry[0] != subfolder ]
+    if campaign is not None:
+        store.close_campaign(campaign)
 
+@instrument.timed
 def read_reference():
     '''
     This function reads the open ear reference impedance
+    - If 'reference' is set, that file is used
     - If only one impedance is present, it will be chosen automatically
-    - If multiple are present, the program will promt to chose one befor plotting
+    - If multiple are present, the program will promt to chose one befor plotting (only in interactive mode)
     '''
-    global Z_ref, frequencies
+    global Z_ref, frequencies, reference
 
-    ref_folder = './reference'
     if not os.path.exists(ref_folder):
         print(f'ERROR: Reference folder not found')
         return
-    
+
     files = [ file for file in os.listdir(ref_folder) if file.endswith('.csv') ]
+    if reference is not None:
+        files = [ file for file in files if file == os.path.basename(reference) ]
     if not files:
         print(f'ERROR: No valid reference files (.csv)')
+        return
 
     print('Select an open ear canal radiation impedance as reference')
     for i, file in enumerate(files):
         print(f'{i+1}: {file}')
-    
+
+    if len(files) > 1 and not interactive:
+        print(f'ERROR: Several references found, select one with --reference')
+        return
+
     while True:
         try:
             if len(files) == 1:
@@ -233,21 +219,14 @@ def read_reference():
             if 1 <= choice <= len(files):
                 sel_file = files[choice-1]
                 print(f'{sel_file} selected')
+                reference = sel_file
 
-                freqObjRaw = read_frequency_csv(file_path = os.path.join(ref_folder, sel_file))
-                
-                frequenciesRaw = freqObjRaw.frequencies
-                freqsRaw = freqObjRaw.freq[0]
-
-                mask = (frequenciesRaw >= freq_range[0]) & (frequenciesRaw <= freq_range[1])
-
-                frequenciesNew = frequenciesRaw[mask]
-                freqs = freqsRaw[mask]
+                frequenciesNew, freqs = read_cropped(os.path.join(ref_folder, sel_file), freq_range)
 
                 if np.array_equal(frequencies, []):
                     frequencies = frequenciesNew
-                
-                Z_ref = pf.FrequencyData(freqs / S_ec, frequencies = frequenciesNew)
+
+                Z_ref = freqs / S_ec
                 return
 
             else:
@@ -255,108 +234,198 @@ def read_reference():
         except ValueError:
             print(f'ERROR: Enter a number between 1 and {len(files)}')
 
+@instrument.timed
 def read_occlusion_data():
     '''
     This function reads reference occlusion effect data to compare to the simulation
     '''
-    global occl_plots, freq_range, frequencies
+    global occl_plots, freq_range, frequencies, workers
 
-    occl_plots_folder = './occlusion_data'
     if not os.path.exists(occl_plots_folder):
         print(f'MESSAGE: Occlusion data folder not found, continuing without')
         return
-    
+
+    csv_files = []
     for subfolder in os.listdir(occl_plots_folder):
         subfolder_path = os.path.join(occl_plots_folder, subfolder)
-        
+
         if not os.path.isdir(subfolder_path) or subfolder == 'no_include':
             continue
-        
+
         occl_plots[subfolder] = {}
-    
+
         for file in os.listdir(subfolder_path):
             file_path = os.path.join(subfolder_path, file)
             if file == 'config.json':
-                try:
-                    with open(file_path, 'r') as conf_raw:
-                        conf = json.load(conf_raw)
-                        occl_plots[subfolder]['conf'] = conf
-                except Exception as e:
-                    print(f'Error reading config')
+                conf = read_config(file_path)
+                if conf is not None:
+                    occl_plots[subfolder]['conf'] = conf
             if file.endswith('.csv'):
-                try:
-                    freqObjRaw = read_frequency_csv(file_path = file_path)
+                csv_files.append((subfolder, file, file_path))
 
-                    frequenciesRaw = freqObjRaw.frequencies
-                    freqsRaw = freqObjRaw.freq[0]
+    results = read_cropped_many([ file_path for (_, _, file_path) in csv_files ], freq_range, target = frequencies, workers = workers)
 
-                    mask = (frequenciesRaw >= freq_range[0]) & (frequenciesRaw <= freq_range[1])
-
-                    frequenciesNew = frequenciesRaw[mask]
-                    freqs = freqsRaw[mask]
+    for (subfolder, file, _), result in zip(csv_files, results):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            frequenciesNew, freqs = result
+
+            if 'mean' in os.path.splitext(file)[0]:
+                key = 'mean'
+            elif 'std' in os.path.splitext(file)[0]:
+                key = 'std'
+            else:
+                continue
 
-                    if not np.array_equal(frequencies, frequenciesNew):
-                        print(f'WARNING: Frequencies of {file} differ from reference. Interpolating....')
-                        freqs = np.interp(frequencies, frequenciesNew, freqs)
-                        frequenciesNew = frequencies
+            occl_plots[subfolder][key] = freqs
 
+            print(f"Processed: {file}")
+        except Exception as e:
+            print(f"ERROR: Couldn't read {file} as FrequencyData")
+            print(e)
 
-                    freq_data = pf.FrequencyData(freqs , frequencies = frequenciesNew)
+def print_load_stats():
+    '''
+    Prints a summary of the cache and of the resampling onto the reference grid
+    '''
+    print(f"MESSAGE: Cache: {cache.stats['hits']} hits, {cache.stats['misses']} misses, {cache.stats['stores']} stores")
+    print(f"MESSAGE: Resampled {resample.stats['files']} files with {resample.stats['tables']} interpolation tables ({resample.stats['table_hits']} reused) in {resample.stats['seconds']*1e3:.1f} ms")
 
-                    if 'mean' in os.path.splitext(file)[0]:
-                        key = 'mean'
-                    elif 'std' in os.path.splitext(file)[0]:
-                        key = 'std'
-                    else:
-                        continue
-                        
-                    occl_plots[subfolder][key] = freq_data
+@instrument.timed
+def ear_muff_simulation(l_cup, l_abs, S_cup, S_abs, k_cup, k_abs, Z_cup, Z_abs, frequencies):
+    '''
+    Load impedance and transfer function of one ear muff on any grid, e.g. the model grid (modelgrid.model_grid)
+    with k_cup, k_abs, Z_cup and Z_abs given on it; interpolate with modelgrid.to_measurement to combine the result
+    '''
+    terms, offset = model_on(frequencies)    # Pinna has 7dB offset to open end (Schüring, Rohr mit Ohr)
 
-                    print(f"Processed: {file}")
-                except Exception as e:
-                    print(f"ERROR: Couldn't read {file} as FrequencyData")
-                    print(e)
+    Z_load_abs = model.input_impedance( *model.line_abcd(k_abs, l_abs, S_abs, Z_abs), np.inf*frequencies )
+    Z_load_cup = model.input_impedance( *model.line_abcd(k_cup, l_cup, S_cup, Z_cup), Z_load_abs )
+    Z_load_sim = model.input_impedance( *model.transmission_line(2*pi*frequencies / c, 0.01, 0.02**2, Z0), Z_load_cup )
+    return ( Z_load_sim, model.transfer_functions( Z_load_sim, terms, offset ) )
 
-def ear_muff_simulation(l_cup, l_abs, S_cup, S_abs, k_cup, k_abs, Z_cup, Z_abs, frequencies):
-    global pinna_offset #= pf.FrequencyData(frequencies*0+10**(7/20), frequencies)  # Pinna has 7dB offset to open end (Schüring, Rohr mit Ohr)
+#%%
+###########################
+##    EC Impedances      ##
+###########################
+@instrument.timed
+def build_model():
+    '''
+    Sets up the ear canal model on the reference grid 'frequencies'
+    '''
+    global pinna_offset, k, K_u, ec_terms
 
-    TL_cup = acoustic_transmission_line(k_cup, l_cup, S_cup, frequencies, Z_cup)
-    TL_abs = acoustic_transmission_line(k_abs, l_abs, S_abs, frequencies, Z_abs)
-    TL_pin = acoustic_transmission_line(k, 0.01, 0.02**2, frequencies)
+    # Wave numbers
+    k = 2*pi*frequencies / c
 
-    Z_load_sim = TL_pin.input_impedance( TL_cup.input_impedance( TL_abs.input_impedance( Z_inf ) ) )
-    return ( Z_load_sim, ( pf.TransmissionMatrix.create_shunt_admittance( 1 / (K_u.input_impedance( Z_load_sim ) * pinna_offset) ) @ K_d ).transfer_function( (1, 1), Z_tm ) )
+    # Upstream section of the ear canal (to exit) as transmission line (A, B, C, D), for the EC loads of Figure 4
+    K_u = model.transmission_line(k, l_u, S_ec, Z0)
 
-#%%
-read_reference()
-read_measurements()
-read_occlusion_data()
+    # Load independent part of the EC network shared by all transfer functions, and the pinna offset
+    ec_terms, pinna_offset = model_on(frequencies)
 
-# Pinna Offset
-pinna_offset = pf.FrequencyData(frequencies*0+10**(7/20), frequencies)
+def ear_parameters():
+    '''
+    Parameters of ear_network: EC geometry, medium and eardrum
+    '''
+    return {'l_u': l_u, 'l_d': l_d, 'S_ec': S_ec, 'c': c, 'Z0': Z0} | model.eardrum_parameters
 
-# Wave numbers
-omega = 2*pi*frequencies
-k = 2*pi*frequencies / c
+def model_on(grid):
+    '''
+    Prepared EC network and pinna offset on a frequency grid, e.g. the model grid of the pure simulations.
+    The network is prepared once per grid and parameter set (model.prepare_network).
 
-# Upstream (to exit) and downstream (to TM) sections of ear canal as transmission lines
-K_u = acoustic_transmission_line(k, l_u, S_ec, frequencies)
-K_d = acoustic_transmission_line(k, l_d, S_ec, frequencies)
+    Returns:
+    - (network.Prepared, np.ndarray)
+    '''
+    return model.prepare_network(ear_network, grid, **ear_parameters()), grid*0+10**(7/20)
 
-#%%
+# %%
 ###########################
-##    EC Impedances      ##
+##    Transfer Funcs     ##
 ###########################
-Z_tm = eardrum_impedance(frequencies = frequencies)                 # Tympanic membrane impedance
-Z_inf = pf.FrequencyData(np.inf*frequencies, frequencies)     # Perfectly occluded with infinite impedance
+@instrument.timed
+def simulate_transfer_functions():
+    '''
+    Evaluates the transfer functions of the reference, perfect occlusion and all measurements
+    '''
+    global T_ref, T_occl_perf
+
+    T_ref = model.transfer_functions( Z_ref, ec_terms )
+    T_occl_perf = modelgrid.simulate( lambda grid: model.transfer_functions( np.inf*grid, model_on(grid)[0] ), frequencies )
+
+    for collection_key, campaign in meas_store.items():
+        evaluate_campaign(campaign)
+
+    index_transfer_functions()
+
+def evaluate_campaign(campaign, rows = None):
+    '''
+    Evaluates a campaign block-wise on slices of its store, or only the given rows (list of row indices). The results
+    ('T' and the EC load impedances 'Z_in' for Figure 4) are stored next to the measured impedances.
+    '''
+    T = campaign.arrays['T'] if 'T' in campaign.arrays else store.create_array(campaign, 'T')
+    Z_in = campaign.arrays['Z_in'] if 'Z_in' in campaign.arrays else store.create_array(campaign, 'Z_in')
+    blocks = store.blocks(campaign) if rows is None else [ rows[first:first + store.chunk] for first in range(0, len(rows), store.chunk) ]
+    for rows in blocks:
+        result = network.evaluate( ec_terms, Z_load = campaign.arrays['Z'][rows], offset = 1 )
+        T[rows], Z_in[rows] = result['T'], result['Z_in']
+
+def index_transfer_functions():
+    '''
+    Lists all (collection, key) in order (meas_index) and the transfer functions per collection (T_meas_projects)
+    '''
+    global meas_index, T_meas_projects
+
+    meas_index = [ (collection_key, key) for collection_key, campaign in meas_store.items() for key in campaign.labels ]
+    T_meas_projects = [ (collection_key, measurements[collection_key]['conf'], [ (key, meas_store[collection_key].arrays['T'][i]) for i, key in enumerate(meas_store[collection_key].labels) ] if collection_key in meas_store else []) for collection_key in measurements ]
 
 # %%
 ###########################
-##    Transfer Funcs     ##
+##      Statistics       ##
 ###########################
-T_ref = ( pf.TransmissionMatrix.create_shunt_admittance( 1 / K_u.input_impedance( Z_ref ) ) @ K_d ).transfer_function( (1, 1), Z_tm )
-T_occl_perf = ( pf.TransmissionMatrix.create_shunt_admittance( 1 / K_u.input_impedance( Z_inf ) ) @ K_d ).transfer_function( (1, 1), Z_tm )
-T_meas_projects = [ (collection_key, measurements[collection_key]['conf'], [ (key, ( pf.TransmissionMatrix.create_shunt_admittance( 1 / K_u.input_impedance( measurements[collection_key][key] ) ) @ K_d ).transfer_function( (1, 1), Z_tm )) for key in measurements[collection_key] if key != 'conf']) for collection_key in measurements ]
+stat_percentiles = (5, 25, 50, 75, 95)
+# Campaigns with up to this many files get exact percentiles (np.percentile), larger ones histogram based (see stats.py)
+stat_exact_rows = 1024
+
+@instrument.timed
+def compute_statistics(collections = None):
+    '''
+    Per collection statistics in one pass over the memory mapped results, read block-wise (see store.blocks)
+    into stats.RunningStats accumulators
+    - T_stats / T_stats_db: |T| (linear and dB) of the transfer functions, percentiles are exact up to stat_exact_rows files
+    - Z_in_stats: |Z_in| of the EC load impedances (mean and std only)
+    - collections: Only updates these collections (e.g. in watch mode), None recomputes all
+    '''
+    global T_stats, T_stats_db, Z_in_stats
+
+    if collections is None:
+        T_stats, T_stats_db, Z_in_stats = {}, {}, {}
+        collections = list(meas_store)
+
+    for collection_key in collections:
+        for collection_stats in (T_stats, T_stats_db, Z_in_stats):
+            collection_stats.pop(collection_key, None)
+        campaign = meas_store.get(collection_key)
+        if campaign is None or not campaign.labels:
+            continue
+
+        T_linear = stats.RunningStats('linear', stat_percentiles, exact_max = stat_exact_rows)
+        T_db = stats.RunningStats('db', stat_percentiles, exact_max = stat_exact_rows)
+        Z_in = stats.RunningStats('linear')
+        for rows in store.blocks(campaign):
+            T = campaign.arrays['T'][rows]
+            T_linear.update(T)
+            T_db.update(T)
+            Z_in.update(campaign.arrays['Z_in'][rows])
+
+        T_stats[collection_key] = T_linear.result()
+        T_stats_db[collection_key] = T_db.result()
+        Z_in_stats[collection_key] = Z_in.result()
+
+    # Keep the order of the collections
+    T_stats, T_stats_db, Z_in_stats = [ { key: collection_stats[key] for key in meas_store if key in collection_stats } for collection_stats in (T_stats, T_stats_db, Z_in_stats) ]
 
 # %%
 ###########################
@@ -370,160 +439,740 @@ therm_cond = 0.025    # themal conductivity
 Pr = 0.707            # Prandtl number
 poros = 0.9          # porosity
 tortu = 1.1           # tortuosity
-resis = 26000         # air flow resistivity    
+resis = 26000         # air flow resistivity
 visc_l = 8.7e-5       # viscous characteristic length
 therm_l = 1.63e-4     # thermal characteristic length
 
-Z_eq, k_eq = pa.johnson_champoux(resis, rho0, poros, tortu, heats, Pr, atm, visc_l, therm_l, visc, therm_cond, Cp, frequencies, var = 'allard')
+def absorber(resis, poros, tortu, visc_l, therm_l, grid = None):
+    import pyabsorp as pa
+    return pa.johnson_champoux(resis, rho0, poros, tortu, heats, Pr, atm, visc_l, therm_l, visc, therm_cond, Cp, frequencies if grid is None else grid, var = 'allard')
+
+# Box designs, evaluated as one sweep (see design.ear_muff_sweep)
+box_designs = design.design_table(
+    l_cup = [0.1, 0.075, 0.05, 0.15, 0.1, 0.05],
+    l_abs = [0.05, 0.075, 0.1, 0.15, 0.1, 0.15],
+    S_cup = 0.0027, S_abs = 3.5e-3,
+    resis = resis, poros = poros, tortu = tortu, visc_l = visc_l, therm_l = therm_l,
+)
+
+box_styles = [
+    ('l_ext = 10cm, l_foam = 5cm', '#cc071e', '-'),
+    ('l_ext = 7.5cm, l_foam = 7.5cm', '#57ab27', '-'),
+    ('l_ext = 5cm, l_foam = 10cm', '#00549f', '-'),
+    ('l_ext = 15cm, l_foam = 5cm', '#cc071e', '--'),
+    ('l_ext = 10cm, l_foam = 10cm', '#57ab27', '--'),
+    ('l_ext = 5cm, l_foam = 15cm', '#00549f', '--'),
+]
 
-Z_box1, T_box1 = ear_muff_simulation(0.1, 0.05, 0.0027, 3.5e-3, k-1j*6*10**(-2)*np.sqrt(frequencies / (c*(0.0027/pi))), k_eq, Z0, Z_eq, frequencies)
-Z_box2, T_box2 = ear_muff_simulation(0.075, 0.075, 0.0027, 3.5e-3, k-1j*6*10**(-2)*np.sqrt(frequencies / (c*(0.0027/pi))), k_eq, Z0, Z_eq, frequencies)
-Z_box3, T_box3 = ear_muff_simulation(0.05, 0.1, 0.0027, 3.5e-3, k-1j*6*10**(-2)*np.sqrt(frequencies / (c*(0.0027/pi))), k_eq, Z0, Z_eq, frequencies)
+@instrument.timed
+def simulate_boxes():
+    '''
+    Simulates the box designs
+    '''
+    global Z_eq, k_eq, Z_boxes, T_boxes_sim, T_boxes
 
-Z_box4, T_box4 = ear_muff_simulation(0.15, 0.15, 0.0027, 3.5e-3, k-1j*6*10**(-2)*np.sqrt(frequencies / (c*(0.0027/pi))), k_eq, Z0, Z_eq, frequencies)
-Z_box5, T_box5 = ear_muff_simulation(0.1, 0.1, 0.0027, 3.5e-3, k-1j*6*10**(-2)*np.sqrt(frequencies / (c*(0.0027/pi))), k_eq, Z0, Z_eq, frequencies)
-Z_box6, T_box6 = ear_muff_simulation(0.05, 0.15, 0.0027, 3.5e-3, k-1j*6*10**(-2)*np.sqrt(frequencies / (c*(0.0027/pi))), k_eq, Z0, Z_eq, frequencies)
+    Z_eq, k_eq = absorber(resis, poros, tortu, visc_l, therm_l)
 
+    Z_boxes, T_boxes_sim = modelgrid.simulate( lambda grid: np.stack(design.ear_muff_sweep(box_designs, grid, *model_on(grid), absorber, c, rho0)[:2]), frequencies )
+
+    T_boxes = [ (Z_boxes[i], T_boxes_sim[i], label, color, linestyle) for i, (label, color, linestyle) in enumerate(box_styles) ]
+
+# %%
+###########################
+##      Optimization     ##
+###########################
+# Fits cup and absorber to minimize the occlusion effect, or to the mean of an occlusion_data collection if fit_target is set
+run_fit = False
+fit_target = None
+fit_bounds = {'l_cup': (0.02, 0.2), 'l_abs': (0.02, 0.2), 'resis': (5e3, 6e4), 'poros': (0.7, 0.99), 'tortu': (1.0, 2.0), 'visc_l': (2e-5, 2e-4), 'therm_l': (5e-5, 5e-4)}
+fit_fixed = {'S_cup': 0.0027, 'S_abs': 3.5e-3}
+# Processes evaluating the finite differences of the fit (None: one per core), independent of the file readers
+fit_workers = None
+
+@instrument.timed
+def fit():
+    '''
+    Runs the optimization set up by fit_bounds, fit_fixed and fit_target
+    '''
+    global fit_design, fit_value
+
+    target = occl_plots[fit_target]['mean'] if fit_target else None
+    # Designs are swept on the model grid (refined for the box designs in mode 'adaptive'), the objective on the reference grid
+    grid, _ = modelgrid.model_grid(frequencies, lambda grid: design.ear_muff_sweep(box_designs, grid, *model_on(grid), absorber, c, rho0)[1])
+    fit_design, fit_value, _ = design.fit_ear_muff(fit_bounds, fit_fixed, frequencies, *model_on(grid), absorber, T_ref, target = target, workers = fit_workers, grid = None if grid is frequencies else grid, c = c, rho0 = rho0)
+    print(f'Best fit ({fit_value:.3f}): {fit_design}')
+
+# %%
+###########################
+##      Monte Carlo      ##
+###########################
+# Uncertainty of the model parameters (distributions in a JSON file, see montecarlo.py) propagated to
+# percentile bands of the occlusion effect of every measurement, the perfect occlusion and the boxes
+mc_samples = 10000
+mc_seed = None
+mc_workers = 1
+mc_percentiles = (5, 50, 95)
+mc_result = None
+
+@instrument.timed
+def monte_carlo(spec_path):
+    '''
+    Runs the Monte Carlo propagation for the distributions in spec_path and stores the bands in mc_result.
+    While distributions, model parameters, reference and grid are unchanged (e.g. in watch mode), the bands of the
+    perfect occlusion, the boxes and of every measurement with an unchanged impedance are reused from mc_result,
+    only new or changed measurements are propagated.
+    '''
+    global mc_result
+
+    with open(spec_path, 'r') as f:
+        distributions = json.load(f)
+
+    nominal = {'l_ec': l_ec, 'r_ec': r_ec, 'l_c': l_c, 'pinna_offset_db': 7} | model.eardrum_parameters
+    Z_meas = store.stacked(meas_store.values(), 'Z', len(frequencies)) * S_ec
+    labels = [ f'{collection_key}/{key}' for (collection_key, key) in meas_index ]
+    inputs = { 'distributions': distributions, 'nominal': nominal, 'samples': mc_samples, 'seed': mc_seed, 'percentiles': mc_percentiles,
+               'c': c, 'rho0': rho0, 'frequencies': frequencies, 'Z_ref': Z_ref, 'Z_boxes': Z_boxes, 'ear_network': ear_network }
+
+    previous = mc_result if mc_result is not None and same_inputs(mc_result['inputs'], inputs) else None
+    old_rows = { label: row for row, label in enumerate(previous['labels'][:len(previous['Z_meas'])]) } if previous is not None else {}
+    reused = { i for i, label in enumerate(labels) if label in old_rows and np.array_equal(previous['Z_meas'][old_rows[label]], Z_meas[i]) }
+    new = [ i for i in range(len(labels)) if i not in reused ]
+
+    if previous is None:
+        result = montecarlo.propagate(distributions, nominal, frequencies, Z_meas, Z_ref * S_ec, Z_boxes, n_samples = mc_samples, percentiles = mc_percentiles, seed = mc_seed, workers = mc_workers, c = c, rho0 = rho0, ear_network = ear_network)
+    else:
+        # Only the measurement curves of the new run are used (its perfect occlusion is dropped), the perfect occlusion
+        # and box curves come from previous. With a fixed mc_seed the samples, and so the bands, equal those of a full run
+        fresh = montecarlo.propagate(distributions, nominal, frequencies, Z_meas[new], Z_ref * S_ec, None, n_samples = mc_samples, percentiles = mc_percentiles, seed = mc_seed, workers = mc_workers, c = c, rho0 = rho0, ear_network = ear_network) if new else None
+        new_rows = { i: row for row, i in enumerate(new) }
+        sources = [ (fresh, new_rows[i]) if i in new_rows else (previous, old_rows[labels[i]]) for i in range(len(labels)) ]
+        sources += [ (previous, row) for row in range(len(previous['Z_meas']), len(previous['labels'])) ]
+
+        def rows(entry, q = None):
+            return np.array([ (source[entry] if q is None else source[entry][q])[row] for source, row in sources ]).reshape(len(sources), len(frequencies))
+
+        result = { 'count': previous['count'], 'nominal_db': rows('nominal_db'), 'mean_db': rows('mean_db'), 'std_db': rows('std_db'),
+                   'percentiles_db': { q: rows('percentiles_db', q) for q in mc_percentiles } }
+        print(f'MESSAGE: Monte Carlo: reused {len(reused)} of {len(labels)} measurements')
+
+    mc_result = result
+    mc_result['labels'] = labels + ['perfect_occlusion'] + [ label for (label, _, _) in box_styles ]
+    mc_result['distributions'] = distributions
+    mc_result['spec'] = spec_path
+    mc_result['inputs'] = inputs
+    mc_result['Z_meas'] = Z_meas
+
+    lower, upper = mc_result['percentiles_db'][min(mc_percentiles)], mc_result['percentiles_db'][max(mc_percentiles)]
+    print(f"MESSAGE: Monte Carlo: {mc_result['count']} samples, {len(mc_result['labels'])} curves, widest {min(mc_percentiles)}-{max(mc_percentiles)} % band {np.max(upper - lower):.1f} dB")
+
+def same_inputs(old, new):
+    '''
+    Compares two dicts of Monte Carlo inputs, arrays element-wise
+    '''
+    return old.keys() == new.keys() and all( np.array_equal(old[key], new[key]) if isinstance(new[key], np.ndarray) else old[key] == new[key] for key in new )
+
+# %%
+###########################
+##        Export         ##
+###########################
+@instrument.timed
+def export_results(path):
+    '''
+    Exports all transfer functions, impedances and per collection statistics together with the
+    campaign labels, configs and model parameters (see export.write_results for the formats)
+    '''
+    collections = list(T_stats)
+
+    def stacked(collection_stats, entry):
+        return np.array([ collection_stats[collection_key][entry] for collection_key in collections ]).reshape(len(collections), len(frequencies))
+
+    def stacked_percentiles(collection_stats):
+        return np.array([ [ collection_stats[collection_key]['percentiles'][q] for q in stat_percentiles ] for collection_key in collections ]).reshape(len(collections), len(stat_percentiles), len(frequencies))
+
+    arrays = {
+        'frequencies': frequencies,
+        'Z_ref': Z_ref,
+        'T_ref': T_ref,
+        'T_occl_perf': T_occl_perf,
+        'Z_meas': store.stacked(meas_store.values(), 'Z', len(frequencies)),
+        'T_meas': store.stacked(meas_store.values(), 'T', len(frequencies)),
+        'collection_mean': stacked(T_stats, 'mean'),
+        'collection_std': stacked(T_stats, 'std'),
+        'collection_percentiles': stacked_percentiles(T_stats),
+        'collection_mean_db': stacked(T_stats_db, 'mean'),
+        'collection_std_db': stacked(T_stats_db, 'std'),
+        'collection_percentiles_db': stacked_percentiles(T_stats_db),
+        'Z_boxes': Z_boxes,
+        'T_boxes': T_boxes_sim,
+    }
+    if mc_result is not None:
+        arrays['mc_nominal_db'] = mc_result['nominal_db']
+        arrays['mc_mean_db'] = mc_result['mean_db']
+        arrays['mc_std_db'] = mc_result['std_db']
+        arrays['mc_percentiles_db'] = np.stack([ mc_result['percentiles_db'][q] for q in mc_percentiles ], axis=1)
+    metadata = {
+        'reference': reference,
+        'freq_range': freq_range,
+        'measurements': [ list(entry) for entry in meas_index ],
+        'collections': collections,
+        'percentiles': list(stat_percentiles),
+        'configs': { collection_key: measurements[collection_key].get('conf') for collection_key in collections },
+        'boxes': { 'labels': [ label for (label, _, _) in box_styles ] } | { key: values.tolist() for key, values in box_designs.items() },
+        'model': {
+            'c': c, 'rho0': rho0, 'l_ec': l_ec, 'r_ec': r_ec, 'l_c': l_c, 'S_ec': S_ec, 'pinna_offset_db': 7,
+            'absorber': { 'visc': visc, 'heats': heats, 'Cp': Cp, 'therm_cond': therm_cond, 'Pr': Pr, 'atm': atm },
+        },
+    }
+    if mc_result is not None:
+        metadata['monte_carlo'] = { 'samples': mc_result['count'], 'seed': mc_seed, 'percentiles': list(mc_percentiles), 'curves': mc_result['labels'], 'distributions': mc_result['distributions'] }
+    export.write_results(path, arrays, metadata)
 
-T_boxes = [
-    (Z_box1, T_box1, 'l_ext = 10cm, l_foam = 5cm', '#cc071e', '-'), 
-    (Z_box2, T_box2, 'l_ext = 7.5cm, l_foam = 7.5cm', '#57ab27', '-'),
-    (Z_box3, T_box3, 'l_ext = 5cm, l_foam = 10cm', '#00549f', '-'), 
-    (Z_box4, T_box4, 'l_ext = 15cm, l_foam = 5cm', '#cc071e', '--'),
-    (Z_box5, T_box5, 'l_ext = 10cm, l_foam = 10cm', '#57ab27', '--'), 
-    (Z_box6, T_box6, 'l_ext = 5cm, l_foam = 15cm', '#00549f', '--'), 
-]
 # %%
 ###########################
 ##         Plots         ##
 ###########################
+# Backend: 'pyfar' (pf.plot.freq per curve) or 'fast' (one collection per campaign, see plotting.py)
+plot_backend = 'pyfar'
+# Points per decade kept by the fast backend (None: all points) and file format of saved figures
+plot_decimation = None
+figure_format = 'png'
+
+@instrument.timed
+def plot_figures(figures, show = True, output_dir = None):
+    '''
+    Plots the figures enabled in figures (see figures.json)
+    - show: Opens the figures, otherwise they are rendered without a display
+    - output_dir: If set, every figure is saved there as fig<n>.<figure_format>
+    '''
+    if plot_backend == 'fast':
+        return plot_figures_fast(figures, show, output_dir)
+
+    import matplotlib
+    if not show:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as mpatches
+    import pyfar as pf
+
+    def fd(data):
+        instrument.count('pyfar_objects')
+        return pf.FrequencyData(data, frequencies)
+
+    ## Figure 1: Transfer Functions
+    if figures['fig1']['show']:
+        plt.figure(1)
+        plt.title('Transfer functions between EC wall and TM')
+
+        if figures['fig1']['include_open_ear']:
+            pf.plot.freq(fd(T_ref), label = 'Open ear (reference measurement)', color = '#f6a800', linestyle = ':')
+
+        if figures['fig1']['include_perf_occl']:
+            pf.plot.freq(fd(T_occl_perf), label = 'Perfectly occluded (Z=inf)', color = '#4f9d69', linestyle = '-.')
+
+        for T_box in T_boxes:
+            ax = pf.plot.freq( fd(T_box[1]), label = T_box[2], color = T_box[3], linestyle = T_box[4])
+
+        for (_, conf, T_measurements) in T_meas_projects:
+            for (collectionkey, T) in T_measurements:
+                pf.plot.freq(fd(T), label = collectionkey, color = conf['color'], linestyle = conf['linestyle'])
+
+        ax = plt.gca()
+        ax.set_ylim(figures['fig1']['ylim'][0], figures['fig1']['ylim'][1])
+
+        if figures['fig1']['loc_legend'] == 'inner':
+            plt.legend(loc='lower right')
+        elif figures['fig1']['loc_legend'] == 'outer':
+            plt.legend(bbox_to_anchor=(1.05, 1.03), loc = 'upper left')
+
+    ## Figure 2: Occlusion Effect
+    if figures['fig2']['show']:
+        plt.figure(2)
+        plt.title('Estimated occlusion effect (vs reference measurement)')
+
+        if figures['fig2']['include_open_ear']:
+            pf.plot.freq( fd(T_ref / T_ref), label = 'Reference: Open ear canal (no occlusion)', color = '#f6a800', linestyle = ':')
+
+        if figures['fig2']['include_perf_occl']:
+            pf.plot.freq( fd(T_occl_perf / T_ref), label = 'Perfectly occluded (Z = inf)', color = '#4f9d69', linestyle = '-.')
+
+        for (_, conf, T_measurements) in T_meas_projects:
+            for (collectionkey, T) in T_measurements:
+                ax = pf.plot.freq( fd(T / T_ref), label = collectionkey, color = conf['color'], linestyle = conf['linestyle'])
+
+        for key in occl_plots:
+            mean = occl_plots[key]['mean']
+            std = occl_plots[key]['std']
+            color = occl_plots[key]['conf']['color']
+            linestyle = occl_plots[key]['conf']['linestyle']
+
+            pf.plot.freq(fd(mean), label = key, color = color, linestyle = linestyle)
+            plt.fill_between( frequencies, 20*np.log10(np.abs(mean-std)), 20*np.log10(np.abs(mean+std)), color = color, alpha=0.2 )
+
+        ax = plt.gca()
+        ax.set_ylim(figures['fig2']['ylim'][0], figures['fig2']['ylim'][1])
+
+        if figures['fig2']['loc_legend'] == 'inner':
+            plt.legend(loc='lower right')
+        elif figures['fig2']['loc_legend'] == 'outer':
+            plt.legend(bbox_to_anchor=(1.05, 1.03), loc = 'upper left')
+
+    ## Figure 3: Occlusion Effect mean and std of measurement folder
+    if figures['fig3']['show']:
+        plt.figure(3)
+        plt.title('Estimated Occlusion Gain') #occlusion effect (mean and std of measurement folder)')
+
+        if figures['fig3']['include_open_ear']:
+            pf.plot.freq( fd(T_ref / T_ref), label = 'Reference: Open ear canal (no occlusion)', color = '#f6a800', linestyle = ':')
+        if figures['fig3']['include_perf_occl']:
+            pf.plot.freq( fd(T_occl_perf / T_ref), label = 'Perfectly occluded (Z = inf)', color = '#4f9d69', linestyle = '-.')
+
+        for (collectionkey, conf, T_measurements) in T_meas_projects:
+            if collectionkey not in T_stats:
+                continue
+            mean = T_stats[collectionkey]['mean']
+            std = T_stats[collectionkey]['std']
+
+            # Export mean as CSV
+            #mean_csv_path = f"output/mean_{collectionkey}.csv"
+            #with open(mean_csv_path, "w", newline="") as csvfile:
+            #    writer = csv.writer(csvfile)
+            #    writer.writerow(["Frequency (Hz)", "Mean"])
+            #    for f, m in zip(frequencies, mean):
+            #        writer.writerow([f, m])
+
+            ax = pf.plot.freq(fd(mean / T_ref), label = f'{collectionkey} mean and std', color = conf['color'], linestyle = conf['linestyle'])
+            plt.fill_between( frequencies, 20*np.log10(np.abs((mean-std) / T_ref)), 20*np.log10(np.abs((mean+std) / T_ref)), color = ax.lines[-1].get_color(), alpha=0.2 )
+
+        for key in occl_plots:
+            mean = occl_plots[key]['mean']
+            std = occl_plots[key]['std']
+            color = occl_plots[key]['conf']['color']
+            linestyle = occl_plots[key]['conf']['linestyle']
+            ax = pf.plot.freq( fd(mean), label = f'{key}', color = color, linestyle = linestyle, alpha = 0.2, linewidth = 5)
+            #plt.fill_between( frequencies, 20*np.log10(np.abs(mean-std)), 20*np.log10(np.abs(mean+std)), color = color, alpha=0.2 )
+
+        ax = plt.gca()
+        ax.set_ylim(figures['fig3']['ylim'][0], figures['fig3']['ylim'][1])
+
+        if figures['fig3']['loc_legend'] == 'inner':
+            plt.legend(loc='lower right')
+        elif figures['fig3']['loc_legend'] == 'outer':
+            plt.legend(bbox_to_anchor=(1.05, 1.03), loc = 'upper left')
+
+    ## Figure 4: EC Load Impedances
+    if figures['fig4']['show']:
+        plt.figure(4)
+        plt.title('Simulated Load Impedances')
+
+        if figures['fig4']['include_open_ear']:
+            pf.plot.freq( fd(model.input_impedance(*K_u, Z_ref)), color = '#f6a800', linestyle = ':', label = 'open ear')
+
+        for Z_load, _, label, color, linestyle in T_boxes:
+           ax = pf.plot.freq( fd(model.input_impedance(*K_u, Z_load) * pinna_offset), color = 'lightgray', linestyle = linestyle)
+
+        for collection_key in Z_in_stats:
+            mean = Z_in_stats[collection_key]['mean']
+            std = Z_in_stats[collection_key]['std']
+            color = measurements[collection_key]['conf']['color']
+            linestyle = measurements[collection_key]['conf']['linestyle']
+
+            ax = pf.plot.freq(fd(mean), label = f'Mean (bold) and std (shade) of {collection_key}', color = color, linestyle = linestyle)
+            plt.fill_between( frequencies, 20*np.log10(np.abs(mean-std)), 20*np.log10(np.abs(mean+std)), color = color, alpha=0.2 )
+
+        ax = plt.gca()
+        ax.set_ylim(figures['fig4']['ylim'][0], figures['fig4']['ylim'][1])
+
+        handles, labels = ax.get_legend_handles_labels()
+        patch = mpatches.Patch(color='lightgray', label='Simulations')
+        handles.append(patch)
+
+        if figures['fig4']['loc_legend'] == 'inner':
+            plt.legend(handles=handles, loc='lower right')
+        elif figures['fig4']['loc_legend'] == 'outer':
+            plt.legend(handles=handles, bbox_to_anchor=(1.05, 1.03), loc = 'upper left')
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        for num in plt.get_fignums():
+            plt.figure(num).savefig(os.path.join(output_dir, f'fig{num}.{figure_format}'), bbox_inches='tight')
+            print(f'Saved: fig{num}.{figure_format}')
+
+    if show:
+        plt.show()
+    else:
+        plt.close('all')
+
+@instrument.timed
+def plot_figures_fast(figures, show = True, output_dir = None):
+    '''
+    Same figures as plot_figures, but every campaign is drawn as one LineCollection and every band as one
+    PolyCollection. dB magnitudes are computed once and decimated to plot_decimation points per decade if set.
+    Without show, figures are rendered headless (no pyplot) and only saved.
+    '''
+    import matplotlib.patches as mpatches
+
+    decimation = plot_decimation
+    T_ref_db = plotting.db(T_ref)
+    T_occl_perf_db = plotting.db(T_occl_perf)
+    T_db = { collection_key: plotting.db(T_measurements_stack) for collection_key, T_measurements_stack in
+             ( (collection_key, np.array([ T for (_, T) in T_measurements ]).reshape(-1, len(frequencies))) for (collection_key, _, T_measurements) in T_meas_projects ) }
+    occl_db = { key: (plotting.db(occl_plots[key]['mean']), plotting.db(occl_plots[key]['mean'] - occl_plots[key]['std']), plotting.db(occl_plots[key]['mean'] + occl_plots[key]['std'])) for key in occl_plots }
+
+    def references(ax, config, relative):
+        if config['include_open_ear']:
+            label = 'Reference: Open ear canal (no occlusion)' if relative else 'Open ear (reference measurement)'
+            plotting.add_curves(ax, frequencies, T_ref_db - T_ref_db if relative else T_ref_db, label = label, color = '#f6a800', linestyle = ':')
+        if config['include_perf_occl']:
+            label = 'Perfectly occluded (Z = inf)' if relative else 'Perfectly occluded (Z=inf)'
+            plotting.add_curves(ax, frequencies, T_occl_perf_db - T_ref_db if relative else T_occl_perf_db, label = label, color = '#4f9d69', linestyle = '-.')
+
+    drawn = []
+
+    ## Figure 1: Transfer Functions
+    if figures['fig1']['show']:
+        fig, ax = plotting.new_figure(1, show)
+        references(ax, figures['fig1'], False)
+        if T_boxes:
+            plotting.add_curves(ax, frequencies, np.array([ plotting.db(T_box[1]) for T_box in T_boxes ]), decimation,
+                                color = [ T_box[3] for T_box in T_boxes ], linestyle = [ T_box[4] for T_box in T_boxes ])
+            for T_box in T_boxes:
+                ax.plot([], [], label = T_box[2], color = T_box[3], linestyle = T_box[4])
+        for (collection_key, conf, T_measurements) in T_meas_projects:
+            if T_measurements:
+                plotting.add_curves(ax, frequencies, T_db[collection_key], decimation, label = collection_key, color = conf['color'], linestyle = conf['linestyle'])
+        plotting.format_axes(ax, frequencies, 'Transfer functions between EC wall and TM', figures['fig1']['ylim'], figures['fig1']['loc_legend'])
+        drawn.append((1, fig))
+
+    ## Figure 2: Occlusion Effect
+    if figures['fig2']['show']:
+        fig, ax = plotting.new_figure(2, show)
+        references(ax, figures['fig2'], True)
+        for (collection_key, conf, T_measurements) in T_meas_projects:
+            if T_measurements:
+                plotting.add_curves(ax, frequencies, T_db[collection_key] - T_ref_db, decimation, label = collection_key, color = conf['color'], linestyle = conf['linestyle'])
+        for key, (mean_db, lower_db, upper_db) in occl_db.items():
+            conf = occl_plots[key]['conf']
+            plotting.add_curves(ax, frequencies, mean_db, decimation, label = key, color = conf['color'], linestyle = conf['linestyle'])
+            plotting.add_band(ax, frequencies, lower_db, upper_db, decimation, color = conf['color'], alpha = 0.2)
+        plotting.format_axes(ax, frequencies, 'Estimated occlusion effect (vs reference measurement)', figures['fig2']['ylim'], figures['fig2']['loc_legend'])
+        drawn.append((2, fig))
+
+    ## Figure 3: Occlusion Effect mean and std of measurement folder
+    if figures['fig3']['show']:
+        fig, ax = plotting.new_figure(3, show)
+        references(ax, figures['fig3'], True)
+        for (collection_key, conf, _) in T_meas_projects:
+            if collection_key not in T_stats:
+                continue
+            mean = T_stats[collection_key]['mean']
+            std = T_stats[collection_key]['std']
+            plotting.add_curves(ax, frequencies, plotting.db(mean) - T_ref_db, decimation, label = f'{collection_key} mean and std', color = conf['color'], linestyle = conf['linestyle'])
+            plotting.add_band(ax, frequencies, plotting.db(mean - std) - T_ref_db, plotting.db(mean + std) - T_ref_db, decimation, color = conf['color'], alpha = 0.2)
+        for key, (mean_db, _, _) in occl_db.items():
+            conf = occl_plots[key]['conf']
+            plotting.add_curves(ax, frequencies, mean_db, decimation, label = key, color = conf['color'], linestyle = conf['linestyle'], alpha = 0.2, linewidth = 5)
+        plotting.format_axes(ax, frequencies, 'Estimated Occlusion Gain', figures['fig3']['ylim'], figures['fig3']['loc_legend'])
+        drawn.append((3, fig))
+
+    ## Figure 4: EC Load Impedances
+    if figures['fig4']['show']:
+        fig, ax = plotting.new_figure(4, show)
+        if figures['fig4']['include_open_ear']:
+            plotting.add_curves(ax, frequencies, plotting.db(model.input_impedance(*K_u, Z_ref)), decimation, label = 'open ear', color = '#f6a800', linestyle = ':')
+        if T_boxes:
+            Z_in_boxes = model.input_impedance(*K_u, np.array([ T_box[0] for T_box in T_boxes ])) * pinna_offset
+            plotting.add_curves(ax, frequencies, plotting.db(Z_in_boxes), decimation, color = 'lightgray', linestyle = [ T_box[4] for T_box in T_boxes ])
+        for collection_key in Z_in_stats:
+            mean = Z_in_stats[collection_key]['mean']
+            std = Z_in_stats[collection_key]['std']
+            conf = measurements[collection_key]['conf']
+            plotting.add_curves(ax, frequencies, plotting.db(mean), decimation, label = f'Mean (bold) and std (shade) of {collection_key}', color = conf['color'], linestyle = conf['linestyle'])
+            plotting.add_band(ax, frequencies, plotting.db(mean - std), plotting.db(mean + std), decimation, color = conf['color'], alpha = 0.2)
+        handles, _ = ax.get_legend_handles_labels()
+        handles.append(mpatches.Patch(color='lightgray', label='Simulations'))
+        plotting.format_axes(ax, frequencies, 'Simulated Load Impedances', figures['fig4']['ylim'], figures['fig4']['loc_legend'], handles)
+        drawn.append((4, fig))
+
+    if output_dir is not None:
+        for num, fig in drawn:
+            plotting.save_figure(fig, output_dir, num, figure_format)
+
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show()
+
+# %%
+###########################
+##      Watch Mode       ##
+###########################
+def scan_measurements():
+    '''
+    Returns { subfolder: { file: (size, mtime) } } of all CSV and config.json files in the measurements folder
+    '''
+    snapshot = {}
+    if not os.path.isdir(measurements_folder):
+        return snapshot
+
+    for subfolder in os.listdir(measurements_folder):
+        subfolder_path = os.path.join(measurements_folder, subfolder)
+        if not os.path.isdir(subfolder_path) or subfolder == 'no_include':
+            continue
+        snapshot[subfolder] = {}
+        for file in os.listdir(subfolder_path):
+            if file == 'config.json' or file.endswith('.csv'):
+                try:
+                    st = os.stat(os.path.join(subfolder_path, file))
+                except OSError:
+                    continue
+                snapshot[subfolder][file] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+def changed_files(old, new):
+    '''
+    Compares two snapshots (see scan_measurements)
+
+    Returns:
+    - dict: { subfolder: set of added, changed or removed files }
+    '''
+    changed = {}
+    for subfolder in set(old) | set(new):
+        files_old = old.get(subfolder, {})
+        files_new = new.get(subfolder, {})
+        files = { file for file in set(files_old) | set(files_new) if files_old.get(file) != files_new.get(file) }
+        if files or (subfolder in old) != (subfolder in new):
+            changed[subfolder] = files
+    return changed
+
+@instrument.timed
+def update_campaign(subfolder, changed):
+    '''
+    Re-reads one campaign after files were added, changed or removed. Rows of unchanged files are copied from the
+    current store together with their transfer functions, only the changed files are parsed and simulated.
+    Rows keep the sorted order of the files, whichever of them changed.
+    '''
+    global measurements, meas_store
+
+    subfolder_path = os.path.join(measurements_folder, subfolder)
+    old = meas_store.get(subfolder)
 
-## Figure 1: Transfer Functions
-if figures['fig1']['show']:
-    plt.figure(1)
-    plt.title('Transfer functions between EC wall and TM')
-
-    if figures['fig1']['include_open_ear']:
-        pf.plot.freq(T_ref, label = 'Open ear (reference measurement)', color = '#f6a800', linestyle = ':')
-    
-    if figures['fig1']['include_perf_occl']:
-        pf.plot.freq(T_occl_perf, label = 'Perfectly occluded (Z=inf)', color = '#4f9d69', linestyle = '-.')
-    
-    for T_box in T_boxes:
-        ax = pf.plot.freq( T_box[1], label = T_box[2], color = T_box[3], linestyle = T_box[4])
-
-    for (_, conf, T_measurements) in T_meas_projects:
-        for (collectionkey, T) in T_measurements:
-            pf.plot.freq(T, label = collectionkey, color = conf['color'], linestyle = conf['linestyle'])
-
-    ax.set_ylim(figures['fig1']['ylim'][0], figures['fig1']['ylim'][1])
-    
-    if figures['fig1']['loc_legend'] == 'inner':
-        plt.legend(loc='lower right')
-    elif figures['fig1']['loc_legend'] == 'outer':
-        plt.legend(bbox_to_anchor=(1.05, 1.03), loc = 'upper left')
-
-## Figure 2: Occlusion Effect
-if figures['fig2']['show']:
-    plt.figure(2)
-    plt.title('Estimated occlusion effect (vs reference measurement)')
-
-    if figures['fig2']['include_open_ear']:
-        pf.plot.freq( T_ref / T_ref, label = 'Reference: Open ear canal (no occlusion)', color = '#f6a800', linestyle = ':')
-    
-    if figures['fig2']['include_perf_occl']:
-        pf.plot.freq( T_occl_perf / T_ref, label = 'Perfectly occluded (Z = inf)', color = '#4f9d69', linestyle = '-.')
-
-    for (_, conf, T_measurements) in T_meas_projects:
-        for (collectionkey, T) in T_measurements:
-            ax = pf.plot.freq( T / T_ref, label = collectionkey, color = conf['color'], linestyle = conf['linestyle'])
-
-    for key in occl_plots:
-        mean = occl_plots[key]['mean']
-        std = occl_plots[key]['std']
-        color = occl_plots[key]['conf']['color']
-        linestyle = occl_plots[key]['conf']['linestyle']
-        
-        pf.plot.freq(mean, label = key, color = color, linestyle = linestyle)
-        plt.fill_between( frequencies, 20*np.log10((mean-std).freq[0]), 20*np.log10((mean+std).freq[0]), color = color, alpha=0.2 )
-    
-    ax.set_ylim(figures['fig2']['ylim'][0], figures['fig2']['ylim'][1])
-    
-    if figures['fig2']['loc_legend'] == 'inner':
-        plt.legend(loc='lower right')
-    elif figures['fig2']['loc_legend'] == 'outer':
-        plt.legend(bbox_to_anchor=(1.05, 1.03), loc = 'upper left')
-
-## Figure 3: Occlusion Effect mean and std of measurement folder
-if figures['fig3']['show']:
-    plt.figure(3)
-    plt.title('Estimated Occlusion Gain') #occlusion effect (mean and std of measurement folder)')
-    
-    if figures['fig3']['include_open_ear']:
-        pf.plot.freq( T_ref / T_ref, label = 'Reference: Open ear canal (no occlusion)', color = '#f6a800', linestyle = ':')
-    if figures['fig3']['include_perf_occl']:
-        pf.plot.freq( T_occl_perf / T_ref, label = 'Perfectly occluded (Z = inf)', color = '#4f9d69', linestyle = '-.')
-        
-    for (collectionkey, conf, T_measurements) in T_meas_projects:
-        mean = pf.FrequencyData(sum(abs(sig.freq[0]) for (_, sig) in T_measurements) / len(T_measurements), frequencies)
-        std = pf.FrequencyData(np.sqrt(sum(( abs(sig.freq[0]) - abs(mean.freq[0])) ** 2 for (_, sig) in T_measurements) / len(T_measurements)), frequencies)
-
-        # Export mean as CSV
-        #mean_csv_path = f"output/mean_{collectionkey}.csv"
-        #with open(mean_csv_path, "w", newline="") as csvfile:
-        #    writer = csv.writer(csvfile)
-        #    writer.writerow(["Frequency (Hz)", "Mean"])
-        #    for f, m in zip(frequencies, mean.freq[0]):
-        #        writer.writerow([f, m])
-
-        ax = pf.plot.freq(mean / T_ref, label = f'{collectionkey} mean and std', color = conf['color'], linestyle = conf['linestyle'])
-        plt.fill_between( frequencies, 20*np.log10(((mean-std) / T_ref).freq[0]), 20*np.log10(((mean+std) / T_ref).freq[0]), color = ax.lines[-1].get_color(), alpha=0.2 )
-    
-    for key in occl_plots:
-        mean = occl_plots[key]['mean']
-        std = occl_plots[key]['std']
-        color = occl_plots[key]['conf']['color']
-        linestyle = occl_plots[key]['conf']['linestyle']
-        ax = pf.plot.freq( mean, label = f'{key}', color = color, linestyle = linestyle, alpha = 0.2, linewidth = 5)
-        #plt.fill_between( frequencies, 20*np.log10((mean-std).freq[0]), 20*np.log10((mean+std).freq[0]), color = color, alpha=0.2 )
-    
-    ax.set_ylim(figures['fig3']['ylim'][0], figures['fig3']['ylim'][1])
-    
-    if figures['fig3']['loc_legend'] == 'inner':
-        plt.legend(loc='lower right')
-    elif figures['fig3']['loc_legend'] == 'outer':
-        plt.legend(bbox_to_anchor=(1.05, 1.03), loc = 'upper left')
-                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                     
-## Figure 4: EC Load Impedances
-if figures['fig4']['show']:
-    plt.figure(4)
-    plt.title('Simulated Load Impedances')
-    
-    if figures['fig4']['include_open_ear']:
-        pf.plot.freq( K_u.input_impedance(Z_ref), color = '#f6a800', linestyle = ':', label = 'open ear')
-    
-    for Z_load, _, label, color, linestyle in T_boxes:
-       ax = pf.plot.freq( K_u.input_impedance(Z_load) * pinna_offset, color = 'lightgray', linestyle = linestyle)
-
-    for collection_key in measurements:
-        mean = pf.FrequencyData(sum(abs(K_u.input_impedance(measurements[collection_key][key]).freq[0]) for key in measurements[collection_key] if key != 'conf') / ( len(measurements[collection_key]) - 1 ), frequencies)
-        std = pf.FrequencyData(np.sqrt(sum(( abs(K_u.input_impedance(measurements[collection_key][key]).freq[0]) - abs(mean.freq[0])) ** 2 for key in measurements[collection_key] if key != 'conf') / ( len(measurements[collection_key]) - 1 )), frequencies)
-        color = measurements[collection_key]['conf']['color']
-        linestyle = measurements[collection_key]['conf']['linestyle']
-               
-        ax = pf.plot.freq(mean, label = f'Mean (bold) and std (shade) of {collection_key}', color = color, linestyle = linestyle)
-        plt.fill_between( frequencies, 20*np.log10((mean-std).freq[0]), 20*np.log10((mean+std).freq[0]), color = color, alpha=0.2 )     
-    
-    ax.set_ylim(figures['fig4']['ylim'][0], figures['fig4']['ylim'][1])
-    
-    handles, labels = ax.get_legend_handles_labels()
-    patch = mpatches.Patch(color='lightgray', label='Simulations')
-    handles.append(patch) 
-    
-    if figures['fig4']['loc_legend'] == 'inner':
-        plt.legend(handles=handles, loc='lower right')
-    elif figures['fig4']['loc_legend'] == 'outer':
-        plt.legend(handles=handles, bbox_to_anchor=(1.05, 1.03), loc = 'upper left')
-    
-plt.show()
+    if not os.path.isdir(subfolder_path):
+        release_campaign(subfolder)
+        measurements.pop(subfolder, None)
+        store.remove_campaign(subfolder)
+        print(f'MESSAGE: Removed {subfolder}')
+        return
+
+    conf = measurements.get(subfolder, {}).get('conf')
+    if 'config.json' in changed or conf is None:
+        conf = read_config(os.path.join(subfolder_path, 'config.json')) if os.path.exists(os.path.join(subfolder_path, 'config.json')) else None
+    if conf is None:
+        print(f'WARNING: {subfolder} has no valid config.json, skipped until it is added')
+        release_campaign(subfolder)
+        measurements.pop(subfolder, None)
+        return
+
+    files = sorted( file for file in os.listdir(subfolder_path) if file.endswith('.csv') )
+    old_rows = { key: row for row, key in enumerate(old.labels) } if old is not None else {}
+    reuse = { file: old.arrays['Z'][old_rows[os.path.splitext(file)[0]]] for file in files if file not in changed and os.path.splitext(file)[0] in old_rows }
+
+    # Build the new store next to the current one and swap them when done
+    campaign = store.create_campaign(subfolder + '.update', frequencies, len(files))
+    read_into_store([ (subfolder, file, os.path.join(subfolder_path, file)) for file in files ], { subfolder: campaign }, reuse)
+    campaign = store.finish(campaign)
+
+    reused = { os.path.splitext(file)[0] for file in reuse }
+    T = store.create_array(campaign, 'T')
+    Z_in = store.create_array(campaign, 'Z_in')
+    for row, key in enumerate(campaign.labels):
+        if key in reused:
+            T[row] = old.arrays['T'][old_rows[key]]
+            Z_in[row] = old.arrays['Z_in'][old_rows[key]]
+    evaluate_campaign(campaign, [ row for row, key in enumerate(campaign.labels) if key not in reused ])
+
+    # Views of both stores must be gone before the old one is replaced
+    del T, Z_in, reuse, old
+    release_campaign(subfolder)
+    meas_store[subfolder] = store.rename_campaign(campaign, subfolder)
+    measurements[subfolder] = { 'conf': conf }
+    for row, key in enumerate(meas_store[subfolder].labels):
+        measurements[subfolder][key] = meas_store[subfolder].arrays['Z'][row]
+
+def watch(interval = 1.0, figures = None, output_dir = None, export_path = None):
+    '''
+    Polls the measurements folder and updates the results whenever CSV or config.json files are added, changed or
+    removed. Only the affected campaigns are re-read and re-simulated, the export and the figures (saved to
+    output_dir) are rewritten afterwards. Runs until interrupted (Ctrl+C).
+    '''
+    snapshot = scan_measurements()
+    print(f'MESSAGE: Watching {measurements_folder} for changes (Ctrl+C to stop)')
+
+    try:
+        while True:
+            time.sleep(interval)
+            current = scan_measurements()
+            changed = changed_files(snapshot, current)
+            snapshot = current
+            if not changed:
+                continue
+
+            start = time.perf_counter()
+            for subfolder, files in changed.items():
+                update_campaign(subfolder, files)
+            index_transfer_functions()
+            compute_statistics(list(changed))
+            if mc_result is not None:
+                monte_carlo(mc_result['spec'])
+
+            if export_path is not None:
+                export_results(export_path)
+            if figures is not None and output_dir is not None:
+                plot_figures(figures, show = False, output_dir = output_dir)
+
+            print(f'MESSAGE: Updated {", ".join(sorted(changed))} in {time.perf_counter() - start:.2f} s')
+    except KeyboardInterrupt:
+        print('MESSAGE: Stopped watching')
+
+# %%
+###########################
+##    Command Line       ##
+###########################
+def list_fit_targets(folder):
+    '''
+    Returns the occlusion data collections in folder that provide a mean (valid values of --fit-target)
+    '''
+    if not os.path.isdir(folder):
+        return []
+    return sorted( subfolder for subfolder in os.listdir(folder) if subfolder != 'no_include' and os.path.isdir(os.path.join(folder, subfolder))
+                   and any( file.endswith('.csv') and 'mean' in os.path.splitext(file)[0] for file in os.listdir(os.path.join(folder, subfolder)) ) )
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Simulates occlusion effects for measured ear canal entrance impedances.')
+    parser.add_argument('--reference', help='Reference file in the reference folder (required if several are present in batch mode)')
+    parser.add_argument('--measurements', default=measurements_folder, help='Measurements folder (default: %(default)s)')
+    parser.add_argument('--reference-folder', default=ref_folder, help='Reference folder (default: %(default)s)')
+    parser.add_argument('--occlusion-data', default=occl_plots_folder, help='Occlusion data folder (default: %(default)s)')
+    parser.add_argument('--freq-range', nargs=2, type=float, default=freq_range, metavar=('F_MIN', 'F_MAX'), help='Frequency range in Hz (default: %(default)s)')
+    parser.add_argument('--figures', default='figures.json', help='Figure configuration (default: %(default)s)')
+    parser.add_argument('--output-dir', help='Saves the figures to this folder')
+    parser.add_argument('--export', help='Exports the results to a .npz, .h5 or (any other name) a directory of .npy files')
+    parser.add_argument('--batch', action='store_true', help='Runs non-interactively: no prompt, no figure windows, figures are only rendered with --output-dir')
+    parser.add_argument('--no-plot', action='store_true', help='Skips all figures, matplotlib is not imported')
+    parser.add_argument('--fit', action='store_true', help='Runs the optimization (see fit_bounds)')
+    parser.add_argument('--fit-target', help='Occlusion data collection to fit to instead of minimizing the occlusion effect')
+    parser.add_argument('--fit-workers', type=int, default=fit_workers, help='Number of processes of the fit, 0 uses all cores (default: one per core)')
+    parser.add_argument('--cache', choices=['use', 'rebuild', 'bypass'], default=cache.mode, help='Parsed file cache mode (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=workers, help='Number of parallel file readers (default: one per core)')
+    parser.add_argument('--watch', action='store_true', help='Keeps running and updates export and saved figures when measurement files change (no figure windows)')
+    parser.add_argument('--watch-interval', type=float, default=1.0, help='Polling interval of --watch in s (default: %(default)s)')
+    parser.add_argument('--plot-backend', choices=['pyfar', 'fast'], default=plot_backend, help='Figure rendering, fast draws one collection per campaign (default: %(default)s)')
+    parser.add_argument('--decimate', type=int, default=plot_decimation, metavar='POINTS_PER_DECADE', help='Min/max decimation of the fast backend (default: all points)')
+    parser.add_argument('--figure-format', choices=['png', 'pdf'], default=figure_format, help='File format of saved figures (default: %(default)s)')
+    parser.add_argument('--report', help='Writes the run report (stage timings and counters) as JSON to this file')
+    parser.add_argument('--profile', help='Profiles the run with cProfile and dumps the stats to this file')
+    parser.add_argument('--trace-memory', action='store_true', help='Traces allocations with tracemalloc and reports the peak and the largest allocations')
+    parser.add_argument('--store', default=store.store_dir, help='Folder of the memory mapped measurement store (default: %(default)s)')
+    parser.add_argument('--model-grid', choices=['measurement', 'log', 'adaptive'], default=modelgrid.mode, help='Grid of the pure simulations (perfect occlusion, boxes, fit), interpolated onto the reference grid (default: %(default)s)')
+    parser.add_argument('--grid-points', type=int, default=modelgrid.points_per_decade, metavar='POINTS_PER_DECADE', help='Points per decade of --model-grid log (default: %(default)s)')
+    parser.add_argument('--grid-tolerance', type=float, default=modelgrid.tolerance_db, metavar='DB', help='Interpolation tolerance of --model-grid adaptive in dB (default: %(default)s)')
+    parser.add_argument('--interp', choices=['realimag', 'magphase'], default=resample.mode, help='Interpolation onto the reference grid (default: %(default)s)')
+    parser.add_argument('--monte-carlo', metavar='SPEC', help='Propagates the parameter distributions in this JSON file to percentile bands of the occlusion effect. Each worker keeps a histogram of n_curves * n_freqs * montecarlo.bins * 4 bytes (about 32 MB for 15 curves on 4161 frequencies)')
+    parser.add_argument('--mc-samples', type=int, default=mc_samples, help='Number of Monte Carlo samples (default: %(default)s)')
+    parser.add_argument('--mc-seed', type=int, default=mc_seed, help='Seed of the Monte Carlo samples (default: random)')
+    parser.add_argument('--mc-workers', type=int, default=mc_workers, help='Number of Monte Carlo processes, 0 uses all cores (default: %(default)s)')
+    return parser
+
+def parse_args(argv = None):
+    return build_parser().parse_args(argv)
+
+def main(argv = None):
+    global measurements_folder, ref_folder, occl_plots_folder, reference, interactive, freq_range, workers, run_fit, fit_target, fit_workers, plot_backend, plot_decimation, figure_format, mc_samples, mc_seed, mc_workers
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.fit_target is not None:
+        fit_targets = list_fit_targets(args.occlusion_data)
+        if args.fit_target not in fit_targets:
+            parser.error(f"--fit-target {args.fit_target!r} not found in {args.occlusion_data} (valid: {', '.join(fit_targets) or 'none'})")
+
+    measurements_folder = args.measurements
+    ref_folder = args.reference_folder
+    occl_plots_folder = args.occlusion_data
+    reference = args.reference
+    interactive = not args.batch and sys.stdin.isatty()
+    freq_range = list(args.freq_range)
+    workers = args.workers
+    cache.mode = args.cache
+    resample.mode = args.interp
+    modelgrid.mode = args.model_grid
+    modelgrid.points_per_decade = args.grid_points
+    modelgrid.tolerance_db = args.grid_tolerance
+    store.store_dir = args.store
+    run_fit = run_fit or args.fit or args.fit_target is not None
+    fit_target = args.fit_target or fit_target
+    fit_workers = args.fit_workers or fit_workers
+    plot_backend = args.plot_backend
+    plot_decimation = args.decimate
+    figure_format = args.figure_format
+    mc_samples = args.mc_samples
+    mc_seed = args.mc_seed
+    mc_workers = args.mc_workers or None
+
+    instrument.reset()
+    if args.profile is not None:
+        instrument.start_profile()
+    if args.trace_memory:
+        instrument.start_memory_trace()
+
+    try:
+        return run(args)
+    finally:
+        if args.profile is not None:
+            instrument.stop_profile(args.profile)
+        if args.trace_memory:
+            instrument.memory_report()
+        instrument.report(args.report)
+
+def run(args):
+    '''
+    Runs all stages for the parsed command line arguments, see main
+    '''
+    read_reference()
+    if Z_ref is None:
+        print(f'ERROR: No reference loaded')
+        return 1
+    read_measurements()
+    read_occlusion_data()
+    print_load_stats()
+
+    build_model()
+    simulate_transfer_functions()
+    compute_statistics()
+    simulate_boxes()
+
+    if run_fit:
+        fit()
+
+    if args.monte_carlo is not None:
+        monte_carlo(args.monte_carlo)
+
+    if args.export is not None:
+        export_results(args.export)
+
+    show = not args.batch and not args.watch
+    figures = None
+    if not args.no_plot and (show or args.output_dir is not None):
+        ## Select what to plot:
+        # Read figures configuration from figures.json
+        with open(args.figures, 'r') as f:
+            figures = json.load(f)
+        plot_figures(figures, show = show, output_dir = args.output_dir)
+
+    if args.watch:
+        watch(args.watch_interval, figures = figures, output_dir = args.output_dir, export_path = args.export)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
 # %%
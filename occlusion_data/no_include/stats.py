@@ -0,0 +1,267 @@
+import numpy as np
+
+## Streaming statistics over stacks of spectra
+# Statistics are taken over the magnitude, either linear (|x|) or in dB (20*log10|x|), across the first axis.
+# Mean and (population) std are accumulated with Welford's algorithm, merged batch-wise after Chan et al.
+# Percentiles are exact (np.percentile, linear interpolation between ranks) as long as at most exact_max spectra
+# were added, the values are kept until then. Beyond that they are read from a per-frequency histogram in dB,
+# so memory does not grow with the number of spectra: the same rank interpolation is applied to order statistics
+# located in the bins (spread evenly within a bin), the error is about one bin width. When a batch falls outside the histogram range of a frequency, that
+# range is doubled (pairs of bins are merged) until the batch fits, so no finite value is clamped.
+# Accumulators can be merged, e.g. when they were filled in other processes.
+
+def magnitude(batch, domain):
+    batch = np.abs(np.asarray(batch))
+    if domain == 'db':
+        return 20*np.log10(batch)
+    if domain == 'linear':
+        return batch
+    raise ValueError(f"Unknown domain '{domain}', use 'linear' or 'db'")
+
+class RunningStats:
+    '''
+    Accumulates mean, std and percentiles of spectra in one pass
+
+    Parameters:
+    - domain (str): 'linear' or 'db'
+    - percentiles (tuple): Percentiles in % to track, empty to skip them
+    - bins (int): Histogram bins per frequency, None sizes them to the initial range in steps of resolution_db (16 to 1024)
+    - margin_db (float): The histogram initially spans the dB range of the data seen so far plus this margin on
+      both sides, it is widened when later values fall outside
+    - range_db ((lo, hi)): Initial histogram range in dB instead, scalars or per-frequency arrays (n_freqs,)
+    - dtype: Integer type of the histogram counts, the histogram takes bins * n_freqs * itemsize bytes
+    - exact_max (int): Up to this many spectra are kept for exact percentiles (exact_max * n_freqs * 8 bytes)
+    - resolution_db (float): Bin width of the histogram if bins is None
+
+    Non-finite values (e.g. -inf dB of a zero magnitude) cannot widen the range, they are counted in the outermost
+    bins and in clamped.
+    '''
+    def __init__(self, domain = 'linear', percentiles = (), bins = None, margin_db = 30, range_db = None, dtype = np.int64, exact_max = 0, resolution_db = 0.1):
+        self.domain = domain
+        self.percentiles = tuple(percentiles)
+        self.bins = bins
+        self.dtype = dtype
+        self.margin_db = margin_db
+        self.exact_max = exact_max
+        self.resolution_db = resolution_db
+        self.count = 0
+        self.clamped = 0
+        self.mean = None
+        self.m2 = None
+        self.kept = [] if exact_max > 0 else None
+        self.hist = None
+        self.lo = None
+        self.hi = None
+        self.width = None
+        if range_db is not None:
+            lo, hi = range_db
+            self.lo = np.asarray(lo, dtype=np.float64)
+            self.hi = np.asarray(hi, dtype=np.float64)
+
+    def update(self, batch):
+        '''
+        Adds one spectrum (n_freqs,) or a stack of spectra (n, n_freqs)
+        '''
+        batch = np.atleast_2d(batch)
+        values = magnitude(batch, self.domain)
+
+        n_b = values.shape[0]
+        mean_b = values.mean(axis=0)
+        m2_b = ((values - mean_b)**2).sum(axis=0)
+        self.combine(n_b, mean_b, m2_b)
+
+        if self.percentiles:
+            self.add_values(values)
+
+    def combine(self, n_b, mean_b, m2_b):
+        if self.count == 0:
+            self.mean, self.m2 = mean_b, m2_b
+        else:
+            n = self.count + n_b
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta*n_b/n
+            self.m2 = self.m2 + m2_b + delta**2*self.count*n_b/n
+        self.count += n_b
+
+    def add_values(self, values):
+        '''
+        Keeps values (n, n_freqs) in the domain for exact percentiles, or counts them in the histogram once more than
+        exact_max spectra were added
+        '''
+        if self.kept is not None:
+            self.kept.append(values)
+            if sum(len(kept) for kept in self.kept) <= self.exact_max:
+                return
+            values = np.concatenate(self.kept)
+            self.kept = None
+        self.update_histogram(values if self.domain == 'db' else magnitude(values, 'db'))
+
+    def release_kept(self):
+        '''
+        Moves the kept values into the histogram
+        '''
+        kept, self.kept = self.kept, None
+        if kept:
+            values = np.concatenate(kept)
+            self.update_histogram(values if self.domain == 'db' else magnitude(values, 'db'))
+
+    def merge(self, other):
+        '''
+        Adds the spectra accumulated by other. Histograms with the same range are added bin by bin, otherwise the
+        bins of other are counted at their centers.
+        '''
+        if other.count == 0:
+            return
+        self.combine(other.count, other.mean, other.m2)
+        self.clamped += other.clamped
+        if other.kept is not None:
+            for values in other.kept:
+                self.add_values(values)
+            return
+        self.release_kept()
+        if other.hist is None:
+            return
+        if self.hist is None:
+            self.bins, self.hist, self.lo, self.width = other.bins, other.hist.copy(), other.lo.copy(), other.width.copy()
+        elif self.bins == other.bins and np.array_equal(self.lo, other.lo) and np.array_equal(self.width, other.width):
+            self.hist += other.hist
+        else:
+            # Ranges differ after widening: the bins of other are added at their centers (resolution one bin of other)
+            centers = other.lo + (np.arange(other.bins)[:, None] + 0.5)*other.width
+            self.add_to_histogram(centers, other.hist)
+
+    def update_histogram(self, values_db):
+        n_freqs = values_db.shape[1]
+        if self.hist is None:
+            if self.lo is None:
+                finite = values_db[np.isfinite(values_db)]
+                lo, hi = (finite.min(), finite.max()) if finite.size else (-100, 100)
+                self.lo, self.hi = lo - self.margin_db, hi + self.margin_db
+            if self.bins is None:
+                self.bins = int(np.clip(np.ceil(np.max(self.hi - self.lo) / self.resolution_db), 16, 1024))
+            self.width = np.broadcast_to((self.hi - self.lo) / self.bins, (n_freqs,)).copy()
+            self.lo = np.broadcast_to(np.asarray(self.lo, dtype=np.float64), (n_freqs,)).copy()
+            self.hist = np.zeros((self.bins, n_freqs), dtype=self.dtype)
+
+        self.add_to_histogram(values_db)
+    def add_to_histogram(self, values_db, weights = None):
+        '''
+        Counts values (n, n_freqs) in dB (with weights, e.g. the bins of another histogram), widening the range first
+        '''
+        n_freqs = values_db.shape[1]
+        finite = np.isfinite(values_db)
+        self.clamped += int(np.sum(~finite if weights is None else np.where(finite, 0, weights)))
+        self.widen(np.where(finite, values_db, np.inf).min(axis=0), np.where(finite, values_db, -np.inf).max(axis=0))
+
+        idx = np.clip(np.floor((np.where(np.isnan(values_db), -np.inf, values_db) - self.lo) / self.width), 0, self.bins - 1).astype(np.int64)
+        flat = idx*n_freqs + np.arange(n_freqs)
+        hist = self.hist.reshape(-1)
+        if weights is None and len(flat) < self.bins:
+            # Few spectra: every row hits each frequency once (unique indices), cheaper than a full-size bincount
+            for row in flat:
+                hist[row] += 1
+        else:
+            self.hist += np.bincount(flat.ravel(), weights = None if weights is None else np.ravel(weights), minlength=self.bins*n_freqs).reshape(self.bins, n_freqs).astype(self.dtype)
+
+    def widen(self, low, high):
+        '''
+        Doubles the histogram range of every frequency whose range does not cover [low, high] until it does.
+        Pairs of bins are merged, the old range becomes the lower (extended upwards) or upper half (extended downwards).
+        '''
+        half = self.bins // 2
+        while True:
+            down = low < self.lo
+            up = ~down & (high >= self.lo + self.bins*self.width)
+            if not (down.any() or up.any()):
+                return
+            for cols, shift in ((np.flatnonzero(down), half), (np.flatnonzero(up), 0)):
+                if not cols.size:
+                    continue
+                old = self.hist[:, cols]
+                pairs = old[:2*half].reshape(half, 2, len(cols)).sum(axis=1)
+                new = np.zeros_like(old)
+                new[shift:shift + half] = pairs
+                if self.bins % 2:
+                    new[shift + half] += old[-1]
+                self.hist[:, cols] = new
+                self.lo[cols] -= shift*2*self.width[cols]
+                self.width[cols] *= 2
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    def percentile_values(self, percentiles = None):
+        '''
+        Percentiles in % (None: the tracked ones), exact from the kept values or from the histogram (cumulated once)
+
+        Returns:
+        - dict: percentile -> np.ndarray (n_freqs,)
+        '''
+        percentiles = self.percentiles if percentiles is None else percentiles
+        if not percentiles or self.count == 0:
+            return {}
+        if self.kept is not None:
+            values = np.concatenate(self.kept)
+            return { q: np.percentile(values, q, axis=0) for q in percentiles }
+
+        cumulative = np.cumsum(self.hist, axis=0)
+        below = cumulative - self.hist
+
+        def order_statistic(k):
+            # k-th smallest value (0-based), the values of a bin are spread evenly across it
+            idx = np.minimum((cumulative <= k).sum(axis=0), self.bins - 1)[None]
+            in_bin = np.take_along_axis(self.hist, idx, axis=0)[0]
+            position = np.clip((k - np.take_along_axis(below, idx, axis=0)[0] + 0.5) / np.maximum(in_bin, 1), 0, 1)
+            return self.lo + (idx[0] + position)*self.width
+
+        result = {}
+        for q in percentiles:
+            # Linear interpolation between adjacent ranks, as np.percentile
+            rank = q / 100 * (self.count - 1)
+            k = int(np.floor(rank))
+            values_db = order_statistic(k)
+            if rank > k:
+                values_db = values_db + (rank - k)*(order_statistic(k + 1) - values_db)
+            result[q] = values_db if self.domain == 'db' else 10**(values_db / 20)
+        return result
+
+    def percentile(self, q):
+        '''
+        Percentile q (in %), see percentile_values
+        '''
+        return self.percentile_values((q,))[q]
+
+    def result(self):
+        '''
+        Returns:
+        - dict: 'count', 'mean', 'std', 'percentiles' (percentile -> np.ndarray) and 'clamped' (non-finite values)
+        '''
+        return {
+            'count': self.count,
+            'clamped': self.clamped,
+            'mean': self.mean,
+            'std': self.std,
+            'percentiles': self.percentile_values(),
+        }
+
+def stream_stats(data, domain = 'linear', percentiles = (), **kwargs):
+    '''
+    Statistics of a stacked array (n, n_freqs) or of an iterable of spectra or stacks (e.g. a generator reading files).
+    Percentiles are exact for arrays and histogram based for iterables, see RunningStats.
+
+    Returns:
+    - dict: 'count', 'mean', 'std' and 'percentiles' (percentile -> np.ndarray)
+    '''
+    if isinstance(data, np.ndarray):
+        running = RunningStats(domain)
+        running.update(data)
+        result = running.result()
+        values = magnitude(np.atleast_2d(data), domain)
+        result['percentiles'] = { q: np.percentile(values, q, axis=0) for q in percentiles }
+        return result
+
+    running = RunningStats(domain, percentiles, **kwargs)
+    for batch in data:
+        running.update(batch)
+    return running.result()
@@ -0,0 +1,150 @@
+import os
+import json
+import shutil
+from collections import namedtuple
+
+import numpy as np
+
+## Measurement store
+# Every campaign is a folder in store_dir with
+# - 'frequencies.npy': the common frequency grid
+# - 'labels.json': the measurement labels, row i of every matrix belongs to labels[i]
+# - '<name>.npy': memory mapped (n_rows, n_freqs) matrices, 'Z' holds the measured impedances, later stages add
+#   their results (e.g. 'T') next to it
+# Rows are written block-wise and only slices of the maps are read, so campaigns do not have to fit into memory.
+# Files of a campaign are only replaced or removed after its maps were closed (close_campaign) and every other view
+# of them was dropped, open maps cannot be deleted or moved on Windows.
+store_dir = './.occlusion_store'
+chunk = 256
+
+Campaign = namedtuple('Campaign', ['path', 'frequencies', 'labels', 'arrays'])
+
+def campaign_path(name):
+    return os.path.join(store_dir, name)
+
+def create_campaign(name, frequencies, n_rows):
+    '''
+    Creates (or overwrites) the store of a campaign with room for n_rows measurements. Maps of a previous store
+    of the same name must be closed first, see close_campaign.
+
+    Returns:
+    - Campaign: Empty campaign, fill it with add_row and close it with finish
+    '''
+    path = campaign_path(name)
+    os.makedirs(path, exist_ok=True)
+    for file in os.listdir(path):
+        if file.endswith('.npy') or file == 'labels.json':
+            os.remove(os.path.join(path, file))
+
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    np.save(os.path.join(path, 'frequencies.npy'), frequencies)
+    Z = np.lib.format.open_memmap(os.path.join(path, 'Z.npy'), mode='w+', dtype=np.complex128, shape=(max(n_rows, 1), len(frequencies)))
+
+    return Campaign(path, frequencies, [], {'Z': Z})
+
+def add_row(campaign, label, data):
+    '''
+    Writes one measurement to the next free row
+
+    Returns:
+    - int: Row of the measurement
+    '''
+    row = len(campaign.labels)
+    campaign.arrays['Z'][row] = data
+    campaign.labels.append(label)
+    return row
+
+def finish(campaign):
+    '''
+    Flushes the campaign and writes its label table. Unused rows (files that could not be read) are cut off.
+
+    Returns:
+    - Campaign: Campaign whose matrices hold exactly one row per label
+    '''
+    campaign.arrays['Z'].flush()
+    with open(os.path.join(campaign.path, 'labels.json'), 'w') as f:
+        json.dump(campaign.labels, f)
+
+    n_rows = len(campaign.labels)
+    return campaign._replace(arrays = { name: data[:n_rows] for name, data in campaign.arrays.items() })
+
+def create_array(campaign, name, dtype = np.complex128):
+    '''
+    Adds a memory mapped (n_rows, n_freqs) matrix to the campaign, e.g. for results derived from 'Z'
+
+    Returns:
+    - np.memmap: The new matrix
+    '''
+    shape = (len(campaign.labels), len(campaign.frequencies))
+    if shape[0] == 0:
+        data = np.empty(shape, dtype=dtype)
+    else:
+        data = np.lib.format.open_memmap(os.path.join(campaign.path, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+    campaign.arrays[name] = data
+    return data
+
+def open_campaign(name, mode = 'r'):
+    '''
+    Opens a finished campaign, all matrices are memory mapped
+
+    Returns:
+    - Campaign
+    '''
+    path = campaign_path(name)
+    with open(os.path.join(path, 'labels.json'), 'r') as f:
+        labels = json.load(f)
+    frequencies = np.load(os.path.join(path, 'frequencies.npy'))
+
+    arrays = {}
+    for file in sorted(os.listdir(path)):
+        if file.endswith('.npy') and file != 'frequencies.npy':
+            arrays[file[:-4]] = np.load(os.path.join(path, file), mmap_mode=mode)[:len(labels)]
+
+    return Campaign(path, frequencies, labels, arrays)
+
+def close_campaign(campaign):
+    '''
+    Flushes the matrices of a campaign and drops them from campaign.arrays. The files are closed as soon as no other
+    view of them is left (e.g. rows handed out to callers).
+    '''
+    for data in campaign.arrays.values():
+        if isinstance(data, np.memmap) and data.mode != 'r':
+            data.flush()
+    campaign.arrays.clear()
+
+def rename_campaign(campaign, name):
+    '''
+    Moves a finished campaign to name, replacing the store there. The maps of campaign are closed and reopened
+    at the new path; the caller must have closed the store at name and dropped its own views of campaign.
+
+    Returns:
+    - Campaign: Campaign at the new path
+    '''
+    close_campaign(campaign)
+    remove_campaign(name)
+    os.rename(campaign.path, campaign_path(name))
+    return open_campaign(name, mode = 'r+')
+
+def remove_campaign(name):
+    '''
+    Deletes the store of a campaign, its maps must be closed (see close_campaign)
+    '''
+    path = campaign_path(name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+def blocks(campaign, start = 0):
+    '''
+    Row slices of at most chunk rows covering the campaign from row start on, for block-wise evaluation
+    '''
+    n_rows = len(campaign.labels)
+    return [ slice(first, min(first + chunk, n_rows)) for first in range(start, n_rows, chunk) ]
+
+def stacked(campaigns, name, n_freqs):
+    '''
+    Concatenates the matrix name of several campaigns (in memory), e.g. for an export
+    '''
+    parts = [ np.asarray(campaign.arrays[name]) for campaign in campaigns ]
+    if not parts:
+        return np.empty((0, n_freqs), dtype=np.complex128)
+    return np.concatenate(parts)